@@ -1,10 +1,24 @@
-from .datasetsplitter import DatasetSplitter
-from .datasetyaml import DatasetYamlWriter
-from .trainer import YOLOTrainer
-from .pipe import FullPipeline
+import importlib
 
 # __init__.py
 
-# This file marks the directory as a Python package and can be used to initialize package-level variables or import submodules.
+# This file marks the directory as a Python package. Submodules are imported on first
+# attribute access (PEP 562), so importing the package doesn't pull in torch or ultralytics.
+_LAZY = {
+    'DatasetSplitter': 'datasetsplitter',
+    'DatasetYamlWriter': 'datasetyaml',
+    'YOLOTrainer': 'trainer',
+    'FullPipeline': 'pipe',
+}
 
-# Example of importing submodules
\ No newline at end of file
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_LAZY[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY))
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import yaml
+import hashlib
+import numpy as np
+from logger import logger
+from tuner import host_fingerprint
+from utils import split_images
+
+HISTORY_FILE = 'benchmarks.jsonl'
+FORMATS = ('pytorch', 'torchscript', 'onnx', 'openvino')
+
+
+def split_source(data_config, split='val'):
+    """The images folder or list file a dataset YAML names for split"""
+    with open(data_config, 'r') as f:
+        return yaml.safe_load(f)[split]
+
+
+def dataset_fingerprint(data_config):
+    """Short hash of the class names and the validation images' names and sizes"""
+    with open(data_config, 'r') as f:
+        config = yaml.safe_load(f)
+    digest = hashlib.sha1(json.dumps(config.get('names'), sort_keys=True).encode('utf-8'))
+    for path in split_images(split_source(data_config)):
+        size = os.path.getsize(path) if os.path.exists(path) else -1
+        digest.update(f"{os.path.basename(path)}:{size}\n".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def model_family(yolo, weights):
+    """The architecture a checkpoint was built from, e.g. yolo11l, so runs of one architecture compare
+
+    Read from the model's yaml: a resumed run records the last.pt it resumed as its model.
+    """
+    yaml_file = (getattr(getattr(yolo, 'model', None), 'yaml', None) or {}).get('yaml_file')
+    return os.path.splitext(os.path.basename(str(yaml_file or weights)))[0]
+
+
+def _size_mb(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(path) for name in names) / 2 ** 20
+    return os.path.getsize(path) / 2 ** 20
+
+
+def load_history(path=HISTORY_FILE):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(records, path=HISTORY_FILE):
+    with open(path, 'a') as f:
+        f.writelines(json.dumps(record) + '\n' for record in records)
+
+
+def measure_latency(yolo, images, imgsz=640, warmup=3):
+    """Per-image predict latencies in ms over decoded images, after a few untimed warmup calls"""
+    for image in images[:warmup]:
+        yolo.predict(image, imgsz=imgsz, verbose=False)
+    latencies = []
+    for image in images:
+        start = time.perf_counter()
+        yolo.predict(image, imgsz=imgsz, verbose=False)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+class BenchmarkSuite:
+    """Benchmark a checkpoint across CPU export formats and keep the results as history.
+
+    Every format is exported, validated for mAP and timed image by image for p50/p95
+    latency. Each record carries the host and dataset fingerprints and is appended to
+    `benchmarks.jsonl`. A record is flagged when its latency or mAP regressed against
+    the best earlier record of the same model family, format, host and dataset, or
+    when the format is slower than PyTorch in the same run.
+    """
+
+    def __init__(self, weights, data_config="dataset_path.yaml", imgsz=640, formats=FORMATS, images=50,
+                 history_path=HISTORY_FILE, family=None, latency_tolerance=0.10, map_tolerance=0.005):
+        self.weights = weights
+        self.data_config = data_config
+        self.imgsz = imgsz
+        self.formats = formats
+        self.images = images
+        self.history_path = history_path
+        self.family = family
+        # Relative p50 slowdown and absolute mAP50-95 drop that count as a regression
+        self.latency_tolerance = latency_tolerance
+        self.map_tolerance = map_tolerance
+
+    def load_images(self):
+        import cv2
+        paths = [path for path in split_images(split_source(self.data_config)) if os.path.exists(path)][:self.images]
+        if not paths:
+            raise FileNotFoundError(f"No validation images on disk for {self.data_config}, latency needs an "
+                                    f"extracted dataset")
+        # Decoded up front so the timings only cover inference
+        return [cv2.imread(path) for path in paths]
+
+    def run_format(self, fmt, images):
+        from ultralytics import YOLO
+        start = time.monotonic()
+        path = self.weights if fmt == 'pytorch' else YOLO(self.weights).export(format=fmt, imgsz=self.imgsz)
+        yolo = YOLO(path, task='detect')
+        metrics = yolo.val(data=self.data_config, imgsz=self.imgsz, batch=1, plots=False, verbose=False)
+        latencies = measure_latency(yolo, images, self.imgsz)
+        return {'size_mb': round(_size_mb(str(path)), 2), 'map': float(metrics.box.map),
+                'map50': float(metrics.box.map50), 'p50_ms': float(np.percentile(latencies, 50)),
+                'p95_ms': float(np.percentile(latencies, 95)), 'fps': float(1000 / latencies.mean()),
+                'seconds': round(time.monotonic() - start, 2)}
+
+    def flag(self, record, history, pytorch=None):
+        """Regression flags of one record against the earlier history"""
+        flags = []
+        key = ('family', 'format', 'host', 'dataset')
+        earlier = [r for r in history if r.get('ok') and all(r.get(k) == record[k] for k in key)]
+        if earlier:
+            best_p50 = min(r['p50_ms'] for r in earlier)
+            best_map = max(r['map'] for r in earlier)
+            if record['p50_ms'] > best_p50 * (1 + self.latency_tolerance):
+                flags.append(f"latency_regression: p50 {record['p50_ms']:.1f} ms vs best {best_p50:.1f} ms")
+            if record['map'] < best_map - self.map_tolerance:
+                flags.append(f"accuracy_regression: mAP50-95 {record['map']:.4f} vs best {best_map:.4f}")
+        if pytorch is not None and record['format'] != 'pytorch' and record['p50_ms'] > pytorch['p50_ms']:
+            flags.append(f"slower_than_pytorch: p50 {record['p50_ms']:.1f} ms vs {pytorch['p50_ms']:.1f} ms")
+        return flags
+
+    def run(self):
+        """Benchmark every format, append the records to the history and return them"""
+        from ultralytics import YOLO
+        host, host_info = host_fingerprint()
+        family = self.family or model_family(YOLO(self.weights), self.weights)
+        base = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'weights': os.path.abspath(self.weights),
+                'family': family, 'imgsz': self.imgsz, 'host': host, 'cpus': host_info['cpus'],
+                'dataset': dataset_fingerprint(self.data_config)}
+        images = self.load_images()
+        history = load_history(self.history_path)
+
+        records = []
+        for fmt in self.formats:
+            record = dict(base, format=fmt)
+            try:
+                record.update(self.run_format(fmt, images), ok=True)
+            except Exception as e:
+                logger.error(f"Benchmark of {fmt} failed: {e}")
+                record.update(ok=False, error=str(e))
+            records.append(record)
+
+        pytorch = next((r for r in records if r['format'] == 'pytorch' and r['ok']), None)
+        for record in records:
+            record['flags'] = self.flag(record, history, pytorch) if record['ok'] else []
+        append_history(records, self.history_path)
+
+        for record in records:
+            if not record['ok']:
+                logger.info(f"{record['format']:>12} ❌ {record['error']}")
+                continue
+            logger.info(f"{record['format']:>12} ✅ {record['size_mb']:8.1f} MB  mAP50-95 {record['map']:.4f}  "
+                        f"p50 {record['p50_ms']:7.2f} ms  p95 {record['p95_ms']:7.2f} ms  {record['fps']:6.2f} FPS")
+            for flag in record['flags']:
+                logger.warning(f"{record['format']}: {flag}")
+        return records
@@ -1,12 +1,47 @@
 import os
 import shutil
-from utils import split_dataset, move_files
+import numpy as np
+import instrument
+from logger import logger
+from labelindex import LabelIndex
+from dedupe import find_duplicates
+from utils import split_dataset, split_images, move_files, is_current, MATERIALIZE_MODES
+
+SPLITS = ('train', 'valid', 'test')
+LAYOUTS = ('tree', 'manifest')
+DEDUPE_MODES = (None, 'drop', 'group')
 
 class DatasetSplitter:
-    def __init__(self, extracted_folder_path, split_ratios=(0.95, 0.025, 0.025), output_dir='datasets'):
+    def __init__(self, extracted_folder_path, split_ratios=(0.95, 0.025, 0.025), output_dir='datasets', keep_source=False,
+                 mode='auto', layout='tree', seed=46, strategy='hash', dedupe=None, dedupe_distance=4):
         self.extracted_folder_path = extracted_folder_path
         self.output_dir = output_dir
         self.split_ratios = split_ratios
+        self.keep_source = keep_source  # Keep the extracted folder, e.g. when it is patched by LabelStudioSync
+        # How files reach the split folders: auto, reflink, hardlink, symlink, rename or copy
+        self.mode = mode
+        # 'tree' materializes datasets/{train,valid,test}, 'manifest' only writes datasets/{split}.txt lists
+        self.layout = layout
+        self.seed = seed
+        self.strategy = strategy
+        # Near-duplicate images are either dropped down to one per group or kept together in one split
+        self.dedupe = dedupe
+        self.dedupe_distance = dedupe_distance
+
+        if self.dedupe not in DEDUPE_MODES:
+            raise ValueError(f"Unknown dedupe mode '{self.dedupe}', expected one of {DEDUPE_MODES}")
+        if self.layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout '{self.layout}', expected one of {LAYOUTS}")
+        if self.layout == 'manifest':
+            # The lists point into the extracted folder, so it has to stay
+            self.keep_source = True
+        if self.mode not in MATERIALIZE_MODES:
+            raise ValueError(f"Unknown mode '{self.mode}', expected one of {MATERIALIZE_MODES}")
+        if self.mode == 'rename' and self.keep_source and self.layout == 'tree':
+            raise ValueError("The 'rename' mode consumes the extracted folder and can't keep the source.")
+        if self.mode == 'symlink':
+            # Symlinks would dangle once the extracted folder is removed
+            self.keep_source = True
 
         assert sum(self.split_ratios) == 1, "Split ratios must sum up to 1."
 
@@ -18,9 +53,11 @@ class DatasetSplitter:
             raise FileNotFoundError("Image or label directory not found.")
 
         # Create output directories for train, valid, test sets
-        for split in ['train', 'valid', 'test']:
-            os.makedirs(os.path.join(self.output_dir, split, 'images'), exist_ok=True)
-            os.makedirs(os.path.join(self.output_dir, split, 'labels'), exist_ok=True)
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.layout == 'tree':
+            for split in SPLITS:
+                os.makedirs(os.path.join(self.output_dir, split, 'images'), exist_ok=True)
+                os.makedirs(os.path.join(self.output_dir, split, 'labels'), exist_ok=True)
 
     def get_image_label_files(self):
         """Get sorted lists of image and label files"""
@@ -39,18 +76,122 @@ class DatasetSplitter:
         """Organize and move the dataset to the output directory"""
         image_files, label_files = self.get_image_label_files()
 
+        duplicates = {}
+        if self.dedupe is not None:
+            with instrument.stage('dedupe'):
+                duplicates = find_duplicates(self.image_dir, max_distance=self.dedupe_distance)
+                instrument.count(images=len(image_files))
+        if self.dedupe == 'drop':
+            keep = [duplicates.get(image, image) == image for image in image_files]
+            image_files = [image for image, kept in zip(image_files, keep) if kept]
+            label_files = [label for label, kept in zip(label_files, keep) if kept]
+
+        histogram = assigned = None
+        if self.strategy == 'stratified':
+            histogram = self.class_histogram(label_files)
+            assigned = self.existing_assignment(label_files)
+
         # Use the custom dataset splitting function
         train_images, train_labels, valid_images, valid_labels, test_images, test_labels = split_dataset(
-            image_files, label_files, self.split_ratios
+            image_files, label_files, self.split_ratios, seed=self.seed, strategy=self.strategy,
+            histogram=histogram, assigned=assigned
         )
 
-        # Move files to their respective directories
-        move_files(train_images, self.image_dir, os.path.join(self.output_dir, 'train', 'images'))
-        move_files(train_labels, self.label_dir, os.path.join(self.output_dir, 'train', 'labels'))
-        move_files(valid_images, self.image_dir, os.path.join(self.output_dir, 'valid', 'images'))
-        move_files(valid_labels, self.label_dir, os.path.join(self.output_dir, 'valid', 'labels'))
-        move_files(test_images, self.image_dir, os.path.join(self.output_dir, 'test', 'images'))
-        move_files(test_labels, self.label_dir, os.path.join(self.output_dir, 'test', 'labels'))
+        splits = {
+            'train': (train_images, train_labels),
+            'valid': (valid_images, valid_labels),
+            'test': (test_images, test_labels),
+        }
+        if self.dedupe == 'group':
+            splits = self.group_duplicates(splits, duplicates)
+        if self.layout == 'manifest':
+            self.write_manifests({split: images for split, (images, _) in splits.items()})
+        else:
+            self.materialize(splits)
+
+        if not self.keep_source:
+            shutil.rmtree(self.extracted_folder_path, ignore_errors=True)
+        instrument.count(images=len(image_files))
+        logger.info("Dataset split and organized successfully.")
+
+    @staticmethod
+    def group_duplicates(splits, duplicates):
+        """Move every near-duplicate into the split of its group's representative so none leak into valid/test"""
+        split_of = {image: split for split, (images, _) in splits.items() for image in images}
+        regrouped = {split: ([], []) for split in splits}
+        for split, (images, labels) in splits.items():
+            for image, label in zip(images, labels):
+                target = split_of.get(duplicates.get(image, image), split)
+                regrouped[target][0].append(image)
+                regrouped[target][1].append(label)
+        return regrouped
+
+    def class_histogram(self, label_files):
+        """Per-image class counts for label_files, from the cached LabelIndex"""
+        index = LabelIndex.build(self.label_dir)
+        return index.image_class_histogram()[np.searchsorted(index.names, label_files)]
+
+    def existing_assignment(self, label_files):
+        """Split index of every label file that is already placed, -1 for new ones
+
+        Stratified splits depend on the whole dataset, so files that were placed
+        before keep their split and only new files are stratified.
+        """
+        placed = {}
+        for split_index, split in enumerate(SPLITS):
+            if self.layout == 'manifest':
+                if not os.path.exists(self.manifest_path(split)):
+                    continue
+                with open(self.manifest_path(split), 'r') as f:
+                    names = [os.path.splitext(os.path.basename(line.strip()))[0] + '.txt' for line in f if line.strip()]
+            else:
+                names = os.listdir(os.path.join(self.output_dir, split, 'labels'))
+            placed.update(dict.fromkeys(names, split_index))
+        return np.array([placed.get(label_file, -1) for label_file in label_files], dtype=np.int64)
+
+    def split_source(self, split):
+        """The images folder or manifest that holds split, for either layout"""
+        if self.layout == 'manifest':
+            return self.manifest_path(split)
+        return os.path.join(self.output_dir, split, 'images')
+
+    def manifest_path(self, split):
+        return os.path.join(self.output_dir, f'{split}.txt')
+
+    def write_manifests(self, split_images):
+        """Write one image list per split pointing into the extracted folder
+
+        Ultralytics finds each label by swapping /images/ for /labels/ in the image path,
+        so the extracted folder is used as-is and no image is copied.
+        """
+        image_dir = os.path.abspath(self.image_dir)
+        for split, images in split_images.items():
+            tmp_path = self.manifest_path(split) + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.writelines(f"{os.path.join(image_dir, image)}\n" for image in images)
+            os.replace(tmp_path, self.manifest_path(split))
+        logger.info(f"Wrote manifests for {sum(len(images) for images in split_images.values())} images to {self.output_dir}")
+
+    def materialize(self, splits):
+        """Bring the split folders in line with the assignment, placing only new or changed files"""
+        totals = {'files': 0, 'bytes': 0, 'seconds': 0.0}
+        unchanged = removed = 0
+        for split, (images, labels) in splits.items():
+            for files, source_dir, kind in ((images, self.image_dir, 'images'), (labels, self.label_dir, 'labels')):
+                target_dir = os.path.join(self.output_dir, split, kind)
+                wanted = set(files)
+                for stale in set(os.listdir(target_dir)) - wanted:
+                    # Deleted upstream or assigned to another split
+                    os.remove(os.path.join(target_dir, stale))
+                    removed += 1
+                pending = [f for f in files if not is_current(os.path.join(source_dir, f), os.path.join(target_dir, f))]
+                unchanged += len(files) - len(pending)
+                stats = move_files(pending, source_dir, target_dir, mode=self.mode)
+                for key, value in stats.items():
+                    totals[key] = totals.get(key, 0) + value
 
-        shutil.rmtree(self.extracted_folder_path, ignore_errors=True)
-        print("Dataset split and organized successfully.")
+        rate = totals['files'] / max(totals['seconds'], 1e-6)
+        methods = {key: value for key, value in totals.items() if key not in ('files', 'bytes', 'seconds')}
+        instrument.count(files=totals['files'], bytes=totals['bytes'])
+        logger.info(f"Materialized {totals['files']} files ({totals['bytes'] / 1e6:.1f} MB) in {totals['seconds']:.2f}s "
+                    f"({rate:.0f} files/s) using {methods}; {unchanged} already in place, {removed} removed")
@@ -1,18 +1,22 @@
 import os , yaml
 from logger import logger
 import shutil
-from sklearn.model_selection import train_test_split
-from ultralytics import YOLO
-import torch
 
 
 class DatasetYamlWriter:
-    def __init__(self,output_file="dataset_path.yaml"):
-        # Fixed paths for train, validation, and test datasets
-        self.train_path = "datasets/train/images"
-        self.val_path = "datasets/valid/images"
-        self.test_path = "datasets/test/images"
+    def __init__(self,output_file="dataset_path.yaml", layout='tree', output_dir='datasets', class_names=None):
+        # Paths for train, validation, and test datasets, matching DatasetSplitter's layout
+        if layout in ('manifest', 'zip'):
+            self.train_path = f"{output_dir}/train.txt"
+            self.val_path = f"{output_dir}/valid.txt"
+            self.test_path = f"{output_dir}/test.txt"
+        else:
+            self.train_path = f"{output_dir}/train/images"
+            self.val_path = f"{output_dir}/valid/images"
+            self.test_path = f"{output_dir}/test/images"
         self.file_path = f"data/classes.txt"
+        # Class names given directly, e.g. read from an export archive that was never extracted
+        self.class_names = class_names
         # Default class names and number of classes
         # self.num_classes = num_classes
         # # self.class_names = [
@@ -24,19 +28,22 @@ class DatasetYamlWriter:
         self.output_file = output_file
 
     def generate_yaml_content(self):
-        with open(self.file_path, 'r') as file:
-            file_contents = file.readlines()
-            nc = len(file_contents)
-            config_data = {
-            'train': f'{os.getcwdb().decode("utf-8")}/datasets/train/images',
-            'val': f'{os.getcwdb().decode("utf-8")}/datasets/valid/images',
-            "nc": nc,
-            "names": [cls.strip() for cls in file_contents]  # List of class names
-            }
-            yaml_file_path = self.output_file
-            with open(yaml_file_path, 'w') as yaml_file:
-                print(config_data)
-                yaml.dump(config_data, yaml_file, default_flow_style=False)
+        if self.class_names is not None:
+            file_contents = [f"{name}\n" for name in self.class_names]
+        else:
+            with open(self.file_path, 'r') as file:
+                file_contents = file.readlines()
+        nc = len(file_contents)
+        config_data = {
+        'train': f'{os.getcwdb().decode("utf-8")}/{self.train_path}',
+        'val': f'{os.getcwdb().decode("utf-8")}/{self.val_path}',
+        "nc": nc,
+        "names": [cls.strip() for cls in file_contents]  # List of class names
+        }
+        yaml_file_path = self.output_file
+        with open(yaml_file_path, 'w') as yaml_file:
+            logger.debug(config_data)
+            yaml.dump(config_data, yaml_file, default_flow_style=False)
         logger.info('Config file ✅')
     def write_yaml(self):
         """Write the YAML content to the output file"""
@@ -45,4 +52,4 @@ class DatasetYamlWriter:
         # # Write the YAML content to the output file
         # with open(self.output_file, "w") as file:
         #     file.write(yaml_content)
-        print(f"YAML file '{self.output_file}' written successfully.")
+        logger.info(f"YAML file '{self.output_file}' written successfully.")
@@ -0,0 +1,159 @@
+import os
+import time
+import numpy as np
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from logger import logger
+
+HASH_FILE = 'image_hashes.npz'
+HASH_METHODS = ('dhash', 'phash')
+_IMAGE_EXTENSIONS = ('.jpg', '.png', '.jpeg')
+
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II matrix, so that D @ x is the DCT of x"""
+    k = np.arange(n)[:, None]
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(32)
+
+
+def _pack_bits(bits):
+    """(images, 64) booleans to one uint64 per image"""
+    return np.packbits(bits.reshape(len(bits), 64), axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def _hash_images(paths):
+    """dHash and pHash of a batch of images, computed together with one batched DCT"""
+    small = np.zeros((len(paths), 8, 9), dtype=np.float32)
+    large = np.zeros((len(paths), 32, 32), dtype=np.float32)
+    ok = np.ones(len(paths), dtype=bool)
+    for i, path in enumerate(paths):
+        try:
+            with Image.open(path) as image:
+                # Let the JPEG decoder downscale while decoding
+                image.draft('L', (64, 64))
+                gray = image.convert('L')
+                small[i] = np.asarray(gray.resize((9, 8), Image.BILINEAR), dtype=np.float32)
+                large[i] = np.asarray(gray.resize((32, 32), Image.BILINEAR), dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Could not hash {path}: {e}")
+            ok[i] = False
+    dhash = _pack_bits(small[:, :, 1:] > small[:, :, :-1])
+    low = (_DCT @ large @ _DCT.T)[:, :8, :8].reshape(len(paths), 64)
+    # The DC term only carries brightness, leave it out of the median
+    phash = _pack_bits(low > np.median(low[:, 1:], axis=1, keepdims=True))
+    return dhash, phash, ok
+
+
+def image_hashes(image_dir, cache_path=None, max_workers=None, chunk_size=256):
+    """Names, dHash and pHash of every image in image_dir, reusing cached hashes of unchanged files"""
+    start = time.monotonic()
+    cache_path = cache_path or os.path.join(os.path.dirname(os.path.abspath(image_dir)), HASH_FILE)
+    entries = sorted((entry.name, entry.stat()) for entry in os.scandir(image_dir)
+                     if entry.name.lower().endswith(_IMAGE_EXTENSIONS) and entry.is_file())
+    names = np.array([name for name, _ in entries], dtype=str)
+    sizes = np.array([st.st_size for _, st in entries], dtype=np.int64)
+    mtimes = np.array([st.st_mtime_ns for _, st in entries], dtype=np.int64)
+    dhash = np.zeros(len(names), dtype=np.uint64)
+    phash = np.zeros(len(names), dtype=np.uint64)
+    ok = np.zeros(len(names), dtype=bool)
+
+    if os.path.exists(cache_path):
+        with np.load(cache_path, allow_pickle=False) as cached:
+            position = {name: i for i, name in enumerate(cached['names'].tolist())}
+            cached_idx = np.array([position.get(name, -1) for name in names.tolist()], dtype=np.int64)
+            hit = np.flatnonzero(cached_idx >= 0)
+            src = cached_idx[hit]
+            hit_ok = (cached['sizes'][src] == sizes[hit]) & (cached['mtimes'][src] == mtimes[hit]) & cached['ok'][src]
+            hit, src = hit[hit_ok], src[hit_ok]
+            dhash[hit], phash[hit], ok[hit] = cached['dhash'][src], cached['phash'][src], True
+
+    fresh = np.flatnonzero(~ok)
+    paths = [os.path.join(image_dir, name) for name in names[fresh].tolist()]
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    if len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_hash_images, chunks))
+    else:
+        results = [_hash_images(chunk) for chunk in chunks]
+    if results:
+        dhash[fresh] = np.concatenate([r[0] for r in results])
+        phash[fresh] = np.concatenate([r[1] for r in results])
+        ok[fresh] = np.concatenate([r[2] for r in results])
+
+    tmp_path = f"{cache_path}.tmp.npz"
+    np.savez(tmp_path, names=names, sizes=sizes, mtimes=mtimes, dhash=dhash, phash=phash, ok=ok)
+    os.replace(tmp_path, cache_path)
+    logger.info(f"Image hashes ✅ {len(names)} images ({len(fresh)} hashed, {len(names) - len(fresh)} cached) "
+                f"in {time.monotonic() - start:.2f}s")
+    return names, dhash, phash, ok
+
+
+def _popcount(values):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1).reshape(values.shape)
+
+
+def near_duplicate_pairs(hashes, max_distance=4, block_rows=1024):
+    """Index pairs whose hashes differ in at most max_distance bits
+
+    Multi-index hashing: the 64 bits are cut into max_distance + 1 blocks, and by the
+    pigeonhole principle any close pair agrees exactly on at least one block. Only
+    hashes that share a block value are compared.
+    """
+    blocks = max_distance + 1
+    edges = np.linspace(0, 64, blocks + 1).astype(np.uint64)
+    pairs = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        keys = (hashes >> lo) & np.uint64((1 << int(hi - lo)) - 1)
+        order = np.argsort(keys, kind='stable')
+        bounds = np.flatnonzero(np.diff(keys[order])) + 1
+        for bucket in np.split(order, bounds):
+            if len(bucket) < 2:
+                continue
+            for row in range(0, len(bucket), block_rows):
+                rows = bucket[row:row + block_rows]
+                distance = _popcount(hashes[rows][:, None] ^ hashes[bucket][None, :])
+                i, j = np.nonzero(distance <= max_distance)
+                keep = rows[i] < bucket[j]
+                pairs.append(np.stack([rows[i][keep], bucket[j][keep]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0) if pairs else np.empty((0, 2), dtype=np.int64)
+
+
+def connected_components(n, pairs):
+    """Smallest member index of the component of every node"""
+    labels = np.arange(n)
+    if not len(pairs):
+        return labels
+    i, j = pairs[:, 0], pairs[:, 1]
+    while True:
+        low = np.minimum(labels[i], labels[j])
+        updated = labels.copy()
+        np.minimum.at(updated, i, low)
+        np.minimum.at(updated, j, low)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+def find_duplicates(image_dir, method='phash', max_distance=4, cache_path=None, max_workers=None):
+    """Map every image that has near-duplicates to the representative of its group
+
+    The representative is the first name of the group in sorted order. Images
+    without near-duplicates are left out of the result.
+    """
+    assert method in HASH_METHODS, f"Hash method must be one of {HASH_METHODS}."
+    names, dhash, phash, ok = image_hashes(image_dir, cache_path=cache_path, max_workers=max_workers)
+    hashes = (phash if method == 'phash' else dhash)[ok]
+    names = names[ok]
+    groups = connected_components(len(names), near_duplicate_pairs(hashes, max_distance))
+    duplicated = np.flatnonzero(np.bincount(groups, minlength=len(names))[groups] > 1)
+    duplicates = dict(zip(names[duplicated].tolist(), names[groups[duplicated]].tolist()))
+    logger.info(f"Found {len(duplicates)} images in {len(set(duplicates.values()))} near-duplicate groups")
+    return duplicates
@@ -0,0 +1,200 @@
+import os
+import json
+import math
+import time
+import hashlib
+import numpy as np
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from logger import logger
+
+IMAGES_FILE = 'images.u8'
+INDEX_FILE = 'index.npz'
+_EXIF_ORIENTATION = 274
+
+
+def _resized_shape(h0, w0, imgsz):
+    """Shape an image gets from ultralytics' load_image: long side to imgsz, aspect kept"""
+    r = imgsz / max(h0, w0)
+    if r == 1:
+        return h0, w0
+    return min(math.ceil(h0 * r), imgsz), min(math.ceil(w0 * r), imgsz)
+
+
+def _read_shapes(paths):
+    """(height, width) of every image as cv2.imread would return it, read from the headers only"""
+    shapes = np.zeros((len(paths), 2), dtype=np.int32)
+    for i, path in enumerate(paths):
+        with Image.open(path) as image:
+            w, h = image.size
+            # cv2.imread applies the EXIF rotation, so rotated images come out transposed
+            if image.getexif().get(_EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+                w, h = h, w
+        shapes[i] = h, w
+    return shapes
+
+
+def _fill(images_path, total_bytes, paths, offsets, shapes):
+    """Decode and resize a batch of images straight into their slots of the shared buffer"""
+    import cv2
+    buffer = np.memmap(images_path, dtype=np.uint8, mode='r+', shape=(total_bytes,))
+    for path, offset, (h, w) in zip(paths, offsets, shapes):
+        im = cv2.imread(path)
+        if im is None:
+            raise ValueError(f"Could not decode {path}")
+        if im.shape[:2] != (h, w):
+            # INTER_LINEAR is what ultralytics uses for augmented training images
+            im = cv2.resize(im, (int(w), int(h)), interpolation=cv2.INTER_LINEAR)
+        buffer[offset:offset + im.size] = im.reshape(-1)
+    buffer.flush()
+    return len(paths)
+
+
+def _fingerprint(paths, imgsz):
+    digest = hashlib.sha1(str(imgsz).encode('utf-8'))
+    for path in paths:
+        st = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def buffer_image(dataset, i, im, hw0, hw):
+    """Record a loaded image the way ultralytics' BaseDataset.load_image does while augmenting.
+
+    Mosaic and MixUp pick their extra images from `dataset.buffer` unless the whole
+    dataset is cached in RAM, so a load_image override that skips this leaves the
+    buffer empty and the first mosaic fails.
+    """
+    if not dataset.augment or dataset.cache == 'ram':
+        return
+    dataset.ims[i], dataset.im_hw0[i], dataset.im_hw[i] = im, hw0, hw
+    dataset.buffer.append(i)
+    if 1 < len(dataset.buffer) >= dataset.max_buffer_length:
+        j = dataset.buffer.pop(0)
+        dataset.ims[j], dataset.im_hw0[j], dataset.im_hw[j] = None, None, None
+
+
+class ImageCache:
+    """Images decoded and resized once, stored back to back in one memory-mapped uint8 buffer.
+
+    Every image is resized the way ultralytics' `load_image` does it (long side to
+    `imgsz`, aspect ratio kept) and stored in BGR order. `index.npz` holds the byte
+    offset of each image, its original and resized shape, and the resize ratio
+    needed to map normalized YOLO labels onto the cached pixels.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with np.load(os.path.join(cache_dir, INDEX_FILE), allow_pickle=False) as index:
+            self.names = index['names']
+            self.offsets = index['offsets']
+            self.hw0 = index['hw0']
+            self.hw = index['hw']
+            self.ratio = index['ratio']
+            self.imgsz = int(index['imgsz'])
+            self.fingerprint = str(index['fingerprint'])
+        self.rows = {name: i for i, name in enumerate(self.names.tolist())}
+        self._images = None
+
+    @property
+    def images(self):
+        # Opened on first use so the cache can be handed to dataloader workers before mapping
+        if self._images is None:
+            self._images = np.memmap(os.path.join(self.cache_dir, IMAGES_FILE), dtype=np.uint8, mode='r')
+        return self._images
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    @classmethod
+    def build(cls, image_paths, cache_dir, imgsz=640, max_workers=None, chunk_size=64):
+        """Decode every image once into cache_dir, reusing the cache if the dataset didn't change"""
+        start = time.monotonic()
+        image_paths = sorted(image_paths, key=os.path.basename)
+        fingerprint = _fingerprint(image_paths, imgsz)
+        if os.path.exists(os.path.join(cache_dir, INDEX_FILE)):
+            cache = cls(cache_dir)
+            if cache.fingerprint == fingerprint:
+                logger.info(f"Image cache in {cache_dir} is up to date")
+                return cache
+        os.makedirs(cache_dir, exist_ok=True)
+
+        chunks = [image_paths[i:i + chunk_size] for i in range(0, len(image_paths), chunk_size)]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            hw0 = np.concatenate(list(executor.map(_read_shapes, chunks)) or [np.zeros((0, 2), dtype=np.int32)])
+            hw = np.array([_resized_shape(h0, w0, imgsz) for h0, w0 in hw0.tolist()], dtype=np.int32).reshape(-1, 2)
+            sizes = hw[:, 0].astype(np.int64) * hw[:, 1] * 3
+            offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64) if len(sizes) else sizes
+            total_bytes = int(sizes.sum())
+
+            images_path = os.path.join(cache_dir, IMAGES_FILE)
+            with open(images_path, 'wb') as f:
+                f.truncate(total_bytes)
+            bounds = range(0, len(image_paths), chunk_size)
+            list(executor.map(_fill, [images_path] * len(chunks), [total_bytes] * len(chunks), chunks,
+                              [offsets[i:i + chunk_size] for i in bounds], [hw[i:i + chunk_size] for i in bounds]))
+
+        names = np.array([os.path.basename(path) for path in image_paths], dtype=str)
+        ratio = (hw[:, 0] / np.maximum(hw0[:, 0], 1)).astype(np.float32)
+        tmp_path = os.path.join(cache_dir, f"{INDEX_FILE}.tmp.npz")
+        np.savez(tmp_path, names=names, offsets=offsets, hw0=hw0, hw=hw, ratio=ratio,
+                 imgsz=np.int64(imgsz), fingerprint=np.array(fingerprint))
+        os.replace(tmp_path, os.path.join(cache_dir, INDEX_FILE))
+        with open(os.path.join(cache_dir, 'stats.json'), 'w') as f:
+            json.dump({'images': len(names), 'bytes': total_bytes, 'imgsz': imgsz,
+                       'seconds': round(time.monotonic() - start, 2)}, f)
+        logger.info(f"Image cache ✅ {len(names)} images, {total_bytes / 1e9:.2f} GB in "
+                    f"{time.monotonic() - start:.1f}s")
+        return cls(cache_dir)
+
+    def row(self, path):
+        return self.rows.get(os.path.basename(path))
+
+    def load(self, row):
+        """(image, original hw, resized hw), the same triple ultralytics' load_image returns"""
+        h, w = self.hw[row]
+        offset = self.offsets[row]
+        # Copy out of the read-only map, augmentations modify the image in place
+        im = np.array(self.images[offset:offset + h * w * 3]).reshape(h, w, 3)
+        return im, tuple(self.hw0[row].tolist()), (int(h), int(w))
+
+    def attach(self, dataset):
+        """Serve a YOLODataset's images from the cache, falling back to disk for anything not cached"""
+        rows = [self.row(path) for path in dataset.im_files]
+        original = dataset.load_image
+
+        def load_image(i, rect_mode=True, **kwargs):
+            # The cache only holds long-side resizes; anything else goes to the dataset's own loader
+            if rows[i] is None or not rect_mode or kwargs.get('resize_short'):
+                return original(i, rect_mode, **kwargs)
+            im, hw0, hw = self.load(rows[i])
+            buffer_image(dataset, i, im, hw0, hw)
+            return im, hw0, hw
+
+        dataset.load_image = load_image
+        missing = sum(row is None for row in rows)
+        if missing:
+            logger.warning(f"{missing} of {len(rows)} images are not in the image cache and are decoded from disk")
+        return dataset
+
+
+def cached_trainer(cache_dir):
+    """A DetectionTrainer whose datasets read images from the ImageCache in cache_dir"""
+    from ultralytics.models.yolo.detect import DetectionTrainer
+
+    class CachedDetectionTrainer(DetectionTrainer):
+        def build_dataset(self, img_path, mode='train', batch=None):
+            dataset = super().build_dataset(img_path, mode, batch)
+            cache = ImageCache(cache_dir)
+            if cache.imgsz != self.args.imgsz:
+                logger.warning(f"Image cache was built for imgsz={cache.imgsz}, training uses {self.args.imgsz}; "
+                               f"decoding from disk")
+                return dataset
+            return cache.attach(dataset)
+
+    return CachedDetectionTrainer
@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import collections
+import multiprocessing
+from contextlib import contextmanager
+from logger import logger
+
+EVENTS_FILE = 'pipeline_events.jsonl'
+PROM_FILE = 'pipeline.prom'
+_COUNTERS = ('files', 'images', 'bytes')
+
+_active = None
+
+
+def _proc_io():
+    """Bytes this process read from and wrote to storage, None where /proc/self/io is missing"""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _vm_hwm_mb(pid='self'):
+    """Peak RSS of a process since its last reset, from /proc/<pid>/status"""
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """Reset VmHWM to the current RSS; False where the kernel doesn't allow it"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Lifetime peak RSS of this process, or with RUSAGE_CHILDREN of its largest finished child, in MB"""
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def live_children_peak_rss_mb():
+    """Summed peak RSS of the live multiprocessing children, e.g. dataloader workers, in MB.
+
+    Pages a forked worker still shares with its parent count once per worker, so this errs high.
+    """
+    return sum(_vm_hwm_mb(child.pid) or 0.0 for child in multiprocessing.active_children())
+
+
+def _cpu_seconds():
+    """CPU time of every thread of this process plus its finished children"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class SamplingProfiler(threading.Thread):
+    """Samples the stacks of every other thread at a fixed interval and counts them as folded stacks"""
+
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True, name='sampling-profiler')
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.halt = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self.halt.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.halt.set()
+        self.join()
+
+    def write(self, path):
+        """Folded stacks, one 'frame;frame;frame count' line each, as flamegraph.pl and speedscope read them"""
+        with open(path, 'w') as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class Instrumentation:
+    """Per-stage wall time, CPU time, peak RSS, storage I/O and throughput, as JSON events and Prometheus gauges.
+
+    Every finished stage appends one JSON line to `events_path` and rewrites the
+    Prometheus textfile `prom_path` (for node_exporter's textfile collector) with the
+    latest values of every stage. Stages nest; peak RSS is measured per stage by
+    resetting the kernel's high-water mark, falling back to the process lifetime
+    peak. The stage named `profile_stage` also runs a sampling profiler and writes
+    its folded stacks to `profile-<stage>.folded`.
+    """
+
+    def __init__(self, events_path=EVENTS_FILE, prom_path=PROM_FILE, profile_stage=None, profile_interval=0.01,
+                 run_id=None):
+        self.events_path = events_path
+        self.prom_path = prom_path
+        self.profile_stage = profile_stage
+        self.profile_interval = profile_interval
+        self.run_id = run_id or time.strftime('%Y%m%dT%H%M%S')
+        self.owner = threading.get_ident()
+        self.local = threading.local()
+        self.latest = {}
+        self.lock = threading.Lock()
+
+    @property
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def emit(self, record):
+        record = dict(record, run=self.run_id, time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        with self.lock, open(self.events_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def event(self, name, **fields):
+        self.emit(dict(fields, event=name))
+
+    def count(self, **amounts):
+        """Add files, images or bytes processed to the innermost stage open on this thread"""
+        if self.stack:
+            for key, amount in amounts.items():
+                self.stack[-1]['counters'][key] += amount
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """Measure the block as one stage; set the yielded record's 'status' to 'error' to mark a failure
+        that didn't raise"""
+        # Only the thread that owns the instrumentation resets the process-wide high-water mark
+        resets = threading.get_ident() == self.owner
+        parent = self.stack[-1] if self.stack else None
+        if resets and parent is not None:
+            parent['peak_mb'] = max(parent['peak_mb'], _vm_hwm_mb() or 0.0)
+        reset = resets and _reset_peak_rss()
+        current = {'name': name, 'counters': collections.Counter(), 'peak_mb': 0.0, 'status': 'ok'}
+        self.stack.append(current)
+        profiler = None
+        if name == self.profile_stage:
+            profiler = SamplingProfiler(self.profile_interval)
+            profiler.start()
+        io_start, cpu_start, wall_start = _proc_io(), _cpu_seconds(), time.monotonic()
+        try:
+            yield current
+        except BaseException:
+            current['status'] = 'error'
+            raise
+        finally:
+            status = current['status']
+            wall = time.monotonic() - wall_start
+            cpu = _cpu_seconds() - cpu_start
+            io_end = _proc_io()
+            self.stack.pop()
+            if reset:
+                peak_mb, peak_source = max(current['peak_mb'], _vm_hwm_mb() or 0.0), 'vm_hwm'
+            else:
+                peak_mb, peak_source = _vm_hwm_mb() or peak_rss_mb(), 'process'
+            if resets and parent is not None:
+                parent['peak_mb'] = max(parent['peak_mb'], peak_mb)
+            counters = {key: current['counters'][key] for key in _COUNTERS}
+            record = dict(fields, event='stage', stage=name, parent=parent['name'] if parent else None,
+                          status=status, wall_s=round(wall, 4), cpu_s=round(cpu, 4),
+                          cpu_util=round(cpu / wall, 3) if wall > 0 else None, peak_rss_mb=round(peak_mb, 1),
+                          peak_rss_source=peak_source, **counters,
+                          images_per_sec=round(counters['images'] / wall, 2) if wall > 0 and counters['images'] else None)
+            if io_start is not None and io_end is not None:
+                record.update(read_bytes=io_end[0] - io_start[0], write_bytes=io_end[1] - io_start[1])
+            if profiler is not None:
+                profiler.stop()
+                record['profile'] = f"profile-{name}.folded"
+                profiler.write(record['profile'])
+            self.emit(record)
+            with self.lock:
+                self.latest[name] = record
+                self.write_prometheus()
+            logger.info(f"[{name}] {status} in {wall:.2f}s, cpu {cpu:.2f}s, peak RSS {peak_mb:.0f} MB"
+                        + (f", {counters['images']} images" if counters['images'] else ''))
+
+    def write_prometheus(self):
+        gauges = {'wall_seconds': 'wall_s', 'cpu_seconds': 'cpu_s', 'peak_rss_megabytes': 'peak_rss_mb',
+                  'read_bytes': 'read_bytes', 'write_bytes': 'write_bytes', 'files': 'files', 'images': 'images',
+                  'images_per_second': 'images_per_sec'}
+        lines = []
+        for metric, key in gauges.items():
+            lines.append(f"# TYPE pyvision_stage_{metric} gauge\n")
+            for stage, record in sorted(self.latest.items()):
+                if record.get(key) is not None:
+                    lines.append(f'pyvision_stage_{metric}{{stage="{stage}"}} {record[key]}\n')
+        lines.append("# TYPE pyvision_stage_success gauge\n")
+        lines.extend(f'pyvision_stage_success{{stage="{stage}"}} {int(record["status"] == "ok")}\n'
+                     for stage, record in sorted(self.latest.items()))
+        tmp_path = f"{self.prom_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.prom_path)
+
+
+def activate(instrumentation):
+    """Make instrumentation the one the module-level helpers record into, None to switch them off"""
+    global _active
+    _active = instrumentation
+    return instrumentation
+
+
+@contextmanager
+def stage(name, **fields):
+    """Record a stage on the active instrumentation, or do nothing if none is active"""
+    if _active is None:
+        yield {'name': name, 'counters': collections.Counter(), 'status': 'ok'}
+        return
+    with _active.stage(name, **fields) as record:
+        yield record
+
+
+def count(**amounts):
+    if _active is not None:
+        _active.count(**amounts)
+
+
+def event(name, **fields):
+    if _active is not None:
+        _active.event(name, **fields)
+
+
+def training_callbacks():
+    """Ultralytics callbacks that emit one 'epoch' event per training epoch, empty if nothing is active"""
+    if _active is None:
+        return {}
+    started = [time.monotonic()]
+
+    def on_train_epoch_start(trainer):
+        started[0] = time.monotonic()
+
+    def on_train_epoch_end(trainer):
+        seconds = time.monotonic() - started[0]
+        images = len(trainer.train_loader.dataset)
+        loss = trainer.label_loss_items(trainer.tloss, prefix='train')
+        event('epoch', epoch=trainer.epoch + 1, epochs=trainer.epochs, seconds=round(seconds, 3), images=images,
+              images_per_sec=round(images / seconds, 2) if seconds > 0 else None,
+              loss={key: round(float(value), 5) for key, value in loss.items()},
+              lr={key: float(value) for key, value in trainer.lr.items()},
+              peak_rss_mb=round(_vm_hwm_mb() or peak_rss_mb(), 1))
+        count(images=images)
+
+    return {'on_train_epoch_start': on_train_epoch_start, 'on_train_epoch_end': on_train_epoch_end}
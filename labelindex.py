@@ -0,0 +1,180 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from logger import logger
+
+INDEX_FILE = 'labels.index.npz'
+_EMPTY_ROWS = np.empty((0, 5), dtype=np.float32)
+
+
+def _parse_label_text(text):
+    """Rows of (class, x, y, w, h) from the contents of one YOLO label file"""
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return _EMPTY_ROWS
+    values = text.split()
+    if len(values) == 5 * len(lines):
+        # Plain detection labels, parse the whole file in one call
+        return np.array(values, dtype=np.float32).reshape(-1, 5)
+    rows = []
+    for line in lines:
+        row = np.array(line.split(), dtype=np.float32)
+        if len(row) == 5:
+            rows.append(row)
+        elif len(row) > 5:
+            # Segmentation polygon, index it by its bounding box
+            xs, ys = row[1::2], row[2::2]
+            x0, x1, y0, y1 = xs.min(), xs.max(), ys.min(), ys.max()
+            rows.append(np.array([row[0], (x0 + x1) / 2, (y0 + y1) / 2, x1 - x0, y1 - y0], dtype=np.float32))
+    return np.stack(rows) if rows else _EMPTY_ROWS
+
+
+def _parse_label_files(paths):
+    """Per-file row counts and the concatenated rows of a batch of label files"""
+    parsed = []
+    for path in paths:
+        with open(path, 'r') as f:
+            parsed.append(_parse_label_text(f.read()))
+    counts = np.array([len(rows) for rows in parsed], dtype=np.int64)
+    return counts, np.concatenate(parsed) if parsed else _EMPTY_ROWS
+
+
+def _ranges(starts, lengths):
+    """Concatenation of arange(start, start + length) for every pair, without a Python loop"""
+    before = np.cumsum(lengths) - lengths
+    return np.repeat(starts - before, lengths) + np.arange(lengths.sum())
+
+
+class LabelIndex:
+    """Columnar index over a folder of YOLO label files.
+
+    Boxes are stored as flat columns (`image_ids`, `classes`, `boxes` xywh) with
+    `offsets` marking where each image's rows start, so every query is a NumPy
+    reduction. The index is cached as an .npz and only files whose size or
+    mtime changed are parsed again.
+    """
+
+    def __init__(self, names, sizes, mtimes, offsets, classes, boxes):
+        self.names = names
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.offsets = offsets
+        self.classes = classes
+        self.boxes = boxes
+        self.counts = np.diff(offsets)
+        self.image_ids = np.repeat(np.arange(len(names), dtype=np.int32), self.counts)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.array([], dtype=str), np.array([], dtype=np.int64), np.array([], dtype=np.int64),
+                   np.zeros(1, dtype=np.int64), np.array([], dtype=np.int16), np.empty((0, 4), dtype=np.float32))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['names'], data['sizes'], data['mtimes'], data['offsets'], data['classes'], data['boxes'])
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, names=self.names, sizes=self.sizes, mtimes=self.mtimes, offsets=self.offsets,
+                 image_ids=self.image_ids, classes=self.classes, boxes=self.boxes)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def build(cls, label_dir, cache_path=None, max_workers=None, chunk_size=2048):
+        """Index every .txt in label_dir, reusing the cached rows of files that haven't changed"""
+        start = time.monotonic()
+        cache_path = cache_path or os.path.join(os.path.dirname(os.path.abspath(label_dir)), INDEX_FILE)
+        entries = sorted((entry.name, entry.stat()) for entry in os.scandir(label_dir)
+                         if entry.name.endswith('.txt') and entry.is_file())
+        names = np.array([name for name, _ in entries], dtype=str)
+        sizes = np.array([st.st_size for _, st in entries], dtype=np.int64)
+        mtimes = np.array([st.st_mtime_ns for _, st in entries], dtype=np.int64)
+
+        cached = cls.empty()
+        if os.path.exists(cache_path):
+            try:
+                cached = cls.load(cache_path)
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable label index {cache_path}: {e}")
+
+        # Match current files against the cache by name, size and mtime
+        position = {name: i for i, name in enumerate(cached.names.tolist())}
+        cached_idx = np.array([position.get(name, -1) for name in names.tolist()], dtype=np.int64)
+        reuse = cached_idx >= 0
+        reuse[reuse] = (cached.sizes[cached_idx[reuse]] == sizes[reuse]) & (cached.mtimes[cached_idx[reuse]] == mtimes[reuse])
+        fresh = np.flatnonzero(~reuse)
+
+        paths = [os.path.join(label_dir, name) for name in names[fresh].tolist()]
+        if len(paths) > chunk_size:
+            chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(_parse_label_files, chunks))
+        else:
+            results = [_parse_label_files(paths)]
+        fresh_counts = np.concatenate([counts for counts, _ in results]) if results else np.array([], dtype=np.int64)
+        fresh_rows = np.concatenate([rows for _, rows in results]) if results else _EMPTY_ROWS
+
+        counts = np.zeros(len(names), dtype=np.int64)
+        reused = np.flatnonzero(reuse)
+        counts[reused] = cached.counts[cached_idx[reused]]
+        counts[fresh] = fresh_counts
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        classes = np.empty(offsets[-1], dtype=np.int16)
+        boxes = np.empty((offsets[-1], 4), dtype=np.float32)
+        dst = _ranges(offsets[reused], counts[reused])
+        src = _ranges(cached.offsets[cached_idx[reused]], counts[reused])
+        classes[dst] = cached.classes[src]
+        boxes[dst] = cached.boxes[src]
+        dst = _ranges(offsets[fresh], counts[fresh])
+        classes[dst] = fresh_rows[:, 0].astype(np.int16)
+        boxes[dst] = fresh_rows[:, 1:]
+
+        index = cls(names, sizes, mtimes, offsets, classes, boxes)
+        index.save(cache_path)
+        logger.info(f"Label index ✅ {len(names)} files, {len(classes)} boxes ({len(fresh)} parsed, "
+                    f"{len(reused)} cached) in {time.monotonic() - start:.2f}s")
+        return index
+
+    @property
+    def stems(self):
+        if not len(self.names):
+            # rpartition can't size its output without a single name
+            return self.names.copy()
+        return np.char.rpartition(self.names, '.')[:, 0]
+
+    @property
+    def num_classes(self):
+        return int(self.classes.max()) + 1 if len(self.classes) else 0
+
+    def labels_for(self, name):
+        """Classes and boxes of one label file"""
+        i = int(np.searchsorted(self.names, name))
+        if i >= len(self.names) or self.names[i] != name:
+            raise KeyError(name)
+        rows = slice(self.offsets[i], self.offsets[i + 1])
+        return self.classes[rows], self.boxes[rows]
+
+    def class_counts(self, num_classes=None):
+        """Number of instances of every class"""
+        return np.bincount(self.classes, minlength=num_classes or self.num_classes)
+
+    def image_class_histogram(self, num_classes=None):
+        """(images, classes) matrix of instance counts per image"""
+        num_classes = num_classes or self.num_classes
+        flat = self.image_ids.astype(np.int64) * num_classes + self.classes
+        return np.bincount(flat, minlength=len(self.names) * num_classes).reshape(len(self.names), num_classes)
+
+    def empty_images(self):
+        """Label files without boxes, i.e. background images"""
+        return self.names[self.counts == 0]
+
+    def images_with_class(self, class_id):
+        return self.names[np.unique(self.image_ids[self.classes == class_id])]
+
+    def box_size_distribution(self, bins=10, class_id=None):
+        """Histogram of sqrt(w * h), the box side relative to the image, optionally for one class"""
+        boxes = self.boxes if class_id is None else self.boxes[self.classes == class_id]
+        return np.histogram(np.sqrt(boxes[:, 2] * boxes[:, 3]), bins=bins, range=(0.0, 1.0))
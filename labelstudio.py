@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import hashlib
+import requests
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from logger import logger
+from utils import make_session, _ls_base_url
+
+STATE_FILE = '.ls_sync.json'
+
+
+def _atomic_write(path, data):
+    """Replace path in one step so hardlinked split copies never see a partial write"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class LabelStudioSync:
+    """Keep an extracted YOLO dataset in step with a Label Studio project.
+
+    Only tasks that were added, updated or deleted since the previous sync are
+    fetched; `images/`, `labels/` and `classes.txt` under `target_dir` are patched
+    in place. The state of the last sync lives in `target_dir/.ls_sync.json`.
+    """
+
+    def __init__(self, ls_id, target_dir='data', base_url=None, session=None, page_size=500, max_workers=8):
+        self.ls_id = ls_id
+        self.target_dir = target_dir
+        self.base_url = (base_url or _ls_base_url()).rstrip('/')
+        self.session = session or make_session(pool_size=max_workers)
+        # Images hosted elsewhere (S3/GCS presigned links, other hosts) are fetched without the LS token
+        self.public_session = requests.Session()
+        self.page_size = page_size
+        self.max_workers = max_workers
+
+        self.image_dir = os.path.join(self.target_dir, 'images')
+        self.label_dir = os.path.join(self.target_dir, 'labels')
+        self.state_path = os.path.join(self.target_dir, STATE_FILE)
+
+    def load_state(self):
+        """Load the previous sync state, or an empty one for a fresh target"""
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+            if state.get('project') == self.ls_id:
+                return state
+            logger.warning(f"Sync state in {self.target_dir} belongs to LS_ID {state.get('project')}, starting over")
+        return {'project': self.ls_id, 'classes': None, 'tasks': {}}
+
+    def save_state(self, state):
+        _atomic_write(self.state_path, json.dumps(state).encode('utf-8'))
+
+    def fetch_classes(self):
+        """Class names from the project's labeling config, in the order the YOLO export uses"""
+        response = self.session.get(f"{self.base_url}/api/projects/{self.ls_id}/")
+        response.raise_for_status()
+        labels = set()
+        for control in response.json().get('parsed_label_config', {}).values():
+            labels.update(control.get('labels', []))
+        return sorted(labels)
+
+    def fetch_tasks(self):
+        """Yield every task of the project, page by page"""
+        page = 1
+        while True:
+            response = self.session.get(f"{self.base_url}/api/tasks",
+                                        params={'project': self.ls_id, 'page': page, 'page_size': self.page_size,
+                                                # Annotations are only included with fields=all
+                                                'fields': 'all'})
+            if response.status_code == 404:
+                # Older Label Studio versions answer past the last page with 404
+                return
+            response.raise_for_status()
+            payload = response.json()
+            tasks = payload.get('tasks', []) if isinstance(payload, dict) else payload
+            yield from tasks
+            if len(tasks) < self.page_size:
+                return
+            page += 1
+
+    @staticmethod
+    def task_version(task):
+        """A string that changes whenever the task or any of its annotations changes"""
+        annotations = ','.join(f"{a.get('id')}:{a.get('updated_at')}" for a in task.get('annotations', []))
+        return f"{task.get('updated_at')}|{annotations}"
+
+    @staticmethod
+    def data_version(task):
+        """Digest of the task's data, which changes when its image is replaced"""
+        return hashlib.sha1(json.dumps(task.get('data', {}), sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def image_url(task):
+        data = task.get('data', {})
+        return data.get('image') or next((v for v in data.values() if isinstance(v, str)), None)
+
+    def to_yolo(self, task, classes):
+        """Convert the latest usable annotation of a task into YOLO label lines"""
+        annotations = [a for a in task.get('annotations', []) if not a.get('was_cancelled')]
+        if not annotations:
+            return ''
+        annotation = max(annotations, key=lambda a: a.get('updated_at') or '')
+        lines = []
+        for result in annotation.get('result', []):
+            value = result.get('value', {})
+            names = value.get('rectanglelabels')
+            if not names or names[0] not in classes:
+                continue
+            w, h = value['width'] / 100, value['height'] / 100
+            x, y = value['x'] / 100 + w / 2, value['y'] / 100 + h / 2
+            lines.append(f"{classes.index(names[0])} {x} {y} {w} {h}")
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def _download_image(self, url, path):
+        if url.startswith('/'):
+            url = f"{self.base_url}{url}"
+        own = urlparse(url)[:2] == urlparse(self.base_url)[:2]
+        session = self.session if own else self.public_session
+        with session.get(url, stream=True) as response:
+            response.raise_for_status()
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
+        os.replace(tmp_path, path)
+
+    def _remove(self, entry):
+        for folder, name in ((self.image_dir, entry['image']), (self.label_dir, entry['label'])):
+            path = os.path.join(folder, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def sync(self):
+        """Bring target_dir up to date and return counts of added, updated and deleted tasks"""
+        start = time.monotonic()
+        os.makedirs(self.image_dir, exist_ok=True)
+        os.makedirs(self.label_dir, exist_ok=True)
+        state = self.load_state()
+
+        classes_file = os.path.join(self.target_dir, 'classes.txt')
+        if state['classes'] is None and os.path.exists(classes_file):
+            with open(classes_file, 'r') as f:
+                state['classes'] = [line.strip() for line in f if line.strip()]
+        classes = self.fetch_classes()
+        if state['classes']:
+            # Append new labels so class ids of labels already on disk stay valid
+            classes = state['classes'] + [name for name in classes if name not in state['classes']]
+        state['classes'] = classes
+        _atomic_write(classes_file, ''.join(f"{name}\n" for name in classes).encode('utf-8'))
+
+        known = state['tasks']
+        seen = set()
+        changed = []
+        for task in self.fetch_tasks():
+            task_id = str(task['id'])
+            seen.add(task_id)
+            version = self.task_version(task)
+            if known.get(task_id, {}).get('version') != version:
+                changed.append((task_id, version, task))
+
+        deleted = [task_id for task_id in known if task_id not in seen]
+        for task_id in deleted:
+            self._remove(known.pop(task_id))
+
+        counts = {'added': 0, 'updated': 0, 'deleted': len(deleted), 'failed': 0}
+
+        def apply(item):
+            task_id, version, task = item
+            url = self.image_url(task)
+            if url is None:
+                raise ValueError(f"Task {task_id} has no image")
+            image_name = os.path.basename(urlparse(url).path)
+            label_name = os.path.splitext(image_name)[0] + '.txt'
+            image_path = os.path.join(self.image_dir, image_name)
+            data = self.data_version(task)
+            previous = known.get(task_id)
+            if previous and previous['image'] != image_name:
+                self._remove(previous)
+            # A task whose data changed may point at a new image under the same name
+            replaced = previous is not None and previous.get('data', data) != data
+            if replaced or not os.path.exists(image_path):
+                self._download_image(url, image_path)
+            _atomic_write(os.path.join(self.label_dir, label_name), self.to_yolo(task, classes).encode('utf-8'))
+            return task_id, {'version': version, 'data': data, 'image': image_name, 'label': label_name}, previous is None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(apply, item) for item in changed]
+            for future in futures:
+                try:
+                    task_id, entry, is_new = future.result()
+                except Exception as e:
+                    # The task keeps its old version and is retried on the next sync
+                    logger.error(f"Sync failed for a task of LS_ID {self.ls_id}: {e}")
+                    counts['failed'] += 1
+                    continue
+                known[task_id] = entry
+                counts['added' if is_new else 'updated'] += 1
+
+        self.save_state(state)
+        logger.info(f"Sync ✅ for LS_ID {self.ls_id} in {time.monotonic() - start:.1f}s: {counts}")
+        return counts
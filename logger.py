@@ -0,0 +1,12 @@
+import os
+import logging
+
+# One named logger for every module, configured once; LOG_LEVEL overrides the level
+logger = logging.getLogger('pyvision')
+
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(module)s: %(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    logger.propagate = False
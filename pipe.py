@@ -1,57 +1,437 @@
 import os
+import json
+import time
 import shutil
-from sklearn.model_selection import train_test_split
-from ultralytics import YOLO
-import torch
+import hashlib
+import zipfile
+import yaml
 from datasetsplitter import DatasetSplitter
 from datasetyaml import DatasetYamlWriter
 from trainer import YOLOTrainer
-from utils import download_and_unzip
-import logging
+from utils import download_and_unzip, merge_projects, make_session, project_summary, split_images
+from labelstudio import LabelStudioSync, STATE_FILE as SYNC_STATE_FILE
+from datasetsplitter import SPLITS
+from zipdataset import ZipArchive, write_split_lists, label_member
+from tuner import ThroughputTuner, load_profile
+import instrument
+from instrument import Instrumentation
+from logger import logger
+
+STATE_FILE = '.pipeline_state.json'
+STAGES = ('download', 'merge', 'yaml', 'split', 'train')
+
+
+def fingerprint(*parts):
+    """Short hash of JSON-serialisable parts"""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def file_digest(path):
+    """sha1 of a file's contents, None if it doesn't exist"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
 
 class FullPipeline:
-    def __init__(self, model=None, epochs=None, batch_size=None, LS=None):
+    """Download, merge, write the dataset config, split, train and optionally quantize, as fingerprinted stages.
+
+    Every data stage's fingerprint hashes its parameters together with the
+    fingerprint of the stage before it; the download stage hashes the remote project
+    summary. Training is keyed on a digest of what the splits hold instead, so how
+    the files were placed (materialize mode, layout, image cache) doesn't start a
+    new run. `.pipeline_state.json` records the fingerprint of every finished stage,
+    so a rerun starts at the first stage whose fingerprint changed or whose output is
+    gone. Training runs under a name derived from its fingerprint and resumes from
+    that run's last.pt after an interruption.
+    """
+
+    def __init__(self, model=None, epochs=None, batch_size=None, LS=None, incremental=False, materialize='auto',
+                 layout='tree', split_strategy='hash', max_per_class=None,
+                 dedupe=None, image_cache=False, imgsz=640, tune=False, quantize=False, max_map_drop=0.01,
+                 min_speedup=1.5, instrumented=False, profile_stage=None):
         self.extracted_folder_path = 'data'
         self.data_config = "dataset_path.yaml"
         self.output_dir = "datasets"
-        
+        self.state_path = STATE_FILE
+        self.runs_dir = os.path.abspath(os.path.join('runs', 'detect'))
+
         self.model = model if model is not None else "yolo11n.pt"
         if not self.model.endswith('.pt'):
             raise ValueError("Model file must be a .pt file")
         self.epochs = epochs if epochs is not None else 500
         self.batch_size = batch_size if batch_size is not None else 8
+        # An explicit batch size always wins over a tuned profile
+        self.batch_size_given = batch_size is not None
         self.LS = LS
+        # Sync a single project in place instead of re-exporting it on every run
+        self.incremental = incremental
+        # How DatasetSplitter places files into datasets/, see utils.MATERIALIZE_MODES
+        self.materialize = materialize
+        # 'manifest' writes datasets/{split}.txt lists instead of materializing images
+        self.layout = layout
+        # 'hash' keeps files in place as data grows, 'stratified' balances classes across splits
+        self.split_strategy = split_strategy
+        # Cap on instances per class when merging several projects, None keeps everything
+        self.max_per_class = max_per_class
+        # 'drop' keeps one image per near-duplicate group, 'group' keeps each group within one split
+        self.dedupe = dedupe
+        # Decode and resize every split image once into datasets/image_cache for training
+        self.image_cache = image_cache
+        self.imgsz = imgsz
+        self.image_cache_dir = os.path.join(self.output_dir, 'image_cache')
+        # With layout='zip' the export stays packed here and training reads from it directly
+        self.archive_path = f"{self.extracted_folder_path}.zip"
+        # Measure the fastest batch/workers/cache/threads for this host if no profile was saved yet
+        self.tune = tune
+        # Quantize best.pt to INT8 ONNX after training, published only if it passes the accuracy/latency gate
+        self.quantize = quantize
+        # The gate: the most mAP50-95 the INT8 model may lose and the least p50 speedup it must bring
+        self.max_map_drop = max_map_drop
+        self.min_speedup = min_speedup
+        self.best_weights = None
+        # Record every stage to pipeline_events.jsonl and pipeline.prom, sampling the stacks of profile_stage
+        self.instrumented = instrumented or profile_stage is not None
+        self.profile_stage = profile_stage
 
-        # if self.LS is None:
-        #     logger.warning("LS_ID not provided. Skipping dataset download and split.")
+    @property
+    def ls_ids(self):
+        if self.LS is None:
+            return None
+        return list(self.LS) if isinstance(self.LS, list) else [self.LS]
 
+    @property
+    def multi_project(self):
+        return len(self.ls_ids) > 1
 
+    @property
+    def syncing(self):
+        """Whether the download stage is an in-place Label Studio sync"""
+        return self.incremental and self.layout != 'zip' and not self.multi_project
 
-    def run(self):
-        # Check if datasets folder already exists
-        if os.path.exists(self.output_dir):
-            logging.info(f"'{self.output_dir}' already exists. Skipping dataset split.")
-            if not os.path.exists(self.data_config):
-                logging.error("Please create the config file")
-            else:
-                logging.info("Config file exists")
+    @property
+    def source_path(self):
+        """What the yaml and split stages read: the export archive or the extracted dataset"""
+        return self.archive_path if self.layout == 'zip' else self.extracted_folder_path
+
+    def load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def save_state(self, state):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def remote_summary(self, previous=None):
+        """Summary of every project on Label Studio, or the recorded one if the server can't be reached"""
+        try:
+            with make_session(pool_size=1) as session:
+                return [project_summary(ls_id, session) for ls_id in self.ls_ids]
+        except Exception as e:
+            if previous is None:
+                raise
+            logger.warning(f"Couldn't reach Label Studio ({e}), assuming the projects are unchanged.")
+            return previous
+
+    def fingerprints(self, state):
+        """Fingerprint of every stage, each one chained on the one before it, and the remote summary"""
+        remote = None
+        if self.syncing:
+            # The sync already ran, its state records the version of every task
+            sync_state = file_digest(os.path.join(self.extracted_folder_path, SYNC_STATE_FILE))
+            download = fingerprint('sync', self.ls_ids, sync_state)
         else:
-            # Split dataset
-            # if isinstance(self.LS, list) and (self.LS is None or len(self.LS) == 0):
-            #     logging.error("LS_ID not provided. Skipping dataset download and split.")
-            #     return
-            if self.LS is not None and (isinstance(self.LS, list) or isinstance(self.LS, int)):
-                if not download_and_unzip(self.LS):
-                    return 
-                yaml_writer = DatasetYamlWriter()
-                yaml_writer.write_yaml()
-                splitter = DatasetSplitter(self.extracted_folder_path, output_dir=self.output_dir)
-                splitter.organize_data()
+            remote = self.remote_summary(state.get('download', {}).get('remote'))
+            download = fingerprint('download', self.ls_ids, self.layout == 'zip', remote)
+        merge = fingerprint(download, self.max_per_class if self.multi_project else None)
+        config = fingerprint(merge, self.layout, self.output_dir)
+        split = fingerprint(config, self.split_strategy, self.materialize, self.dedupe, self.image_cache, self.imgsz)
+        fingerprints = {'download': download, 'merge': merge, 'yaml': config, 'split': split}
+        # Until the split exists there is nothing to digest; it is refreshed once the split stage ran
+        self.chain_training(fingerprints, self.split_digest() if self.stage_done('split', state) else None)
+        return fingerprints, remote
+
+    def train_fingerprint(self, upstream):
+        return fingerprint(upstream, self.model, self.epochs, self.imgsz,
+                           self.batch_size if self.batch_size_given else None, self.tune)
+
+    def chain_training(self, fingerprints, upstream):
+        """Set the train fingerprint, and the quantize one chained on it, from the training data's digest"""
+        fingerprints['train'] = self.train_fingerprint(upstream)
+        if self.quantize:
+            fingerprints['quantize'] = fingerprint(fingerprints['train'], 'int8', self.imgsz, self.max_map_drop,
+                                                   self.min_speedup)
+
+    def split_source(self, split):
+        """The images folder or list file of a split, the list names archive members for layout='zip'"""
+        if self.layout == 'tree':
+            return os.path.join(self.output_dir, split, 'images')
+        return os.path.join(self.output_dir, f'{split}.txt')
+
+    def split_digest(self, sources=None):
+        """Digest of which image sits in which split, its size and its labels, whatever the layout or file mode
+
+        sources maps a split to its images folder or list file, the splits this pipeline writes by default.
+        """
+        sources = sources or {split: self.split_source(split) for split in SPLITS}
+        digest = hashlib.sha1()
+        members = None
+        if self.layout == 'zip':
+            with zipfile.ZipFile(self.archive_path, 'r') as zip_ref:
+                members = {info.filename: (info.file_size, info.CRC) for info in zip_ref.infolist()}
+        for split, source in sources.items():
+            for image in split_images(source):
+                if members is not None:
+                    size, labels = members.get(image), members.get(label_member(image))
+                else:
+                    # Ultralytics finds a label by swapping the last /images/ for /labels/
+                    head, _, tail = image.rpartition(f'{os.sep}images{os.sep}')
+                    label = os.path.join(f'{head}{os.sep}labels', os.path.splitext(tail)[0] + '.txt')
+                    size, labels = os.path.getsize(image), file_digest(label)
+                digest.update(f"{split}/{os.path.basename(image)}:{size}:{labels}\n".encode('utf-8'))
+        return digest.hexdigest()[:16]
+
+    def config_digest(self):
+        """Digest of the class names and the splits the dataset config points training at"""
+        with open(self.data_config, 'r') as f:
+            config = yaml.safe_load(f)
+        sources = {split: config[split] for split in ('train', 'val', 'test') if config.get(split)}
+        return fingerprint(config.get('names'), self.split_digest(sources))
+
+    def stage_done(self, stage, state):
+        """Whether a stage recorded with the given fingerprint still has its output in place"""
+        if stage == 'yaml':
+            return os.path.exists(self.data_config)
+        if stage == 'split':
+            if self.layout == 'tree':
+                return os.path.isdir(os.path.join(self.output_dir, 'train'))
+            return os.path.exists(os.path.join(self.output_dir, 'train.txt'))
+        if stage == 'train':
+            return state.get('train', {}).get('status') == 'done'
+        # The download and merge outputs are consumed by the later stages
+        return True
+
+    def is_fresh(self, stage, state, fingerprints):
+        return state.get(stage, {}).get('fingerprint') == fingerprints[stage] and self.stage_done(stage, state)
+
+    def first_stale(self, stages, state, fingerprints):
+        """Index of the first stage whose fingerprint changed or whose output is gone"""
+        return next((i for i, stage in enumerate(stages) if not self.is_fresh(stage, state, fingerprints)), None)
+
+    def rerun_from(self, stages, stale):
+        """Index to rerun from, stepping back to the download when the stale stage's input is gone"""
+        if 'download' not in stages:
+            return stale
+        if stages[stale] == 'merge' and self.multi_project and not os.path.isdir('_temp'):
+            return 0
+        if stages[stale] in ('yaml', 'split') and not os.path.exists(self.source_path):
+            logger.info(f"'{self.source_path}' is gone, downloading again.")
+            return 0
+        return stale
+
+    def prepare(self, keep_source=False):
+        """Write the dataset config and place only new or reassigned files into the splits"""
+        return self.write_config() and self.split(keep_source)
+
+    def write_config(self):
+        class_names = ZipArchive(self.archive_path).class_names() if self.layout == 'zip' else None
+        yaml_writer = DatasetYamlWriter(layout=self.layout, output_dir=self.output_dir, class_names=class_names)
+        yaml_writer.write_yaml()
+        return True
+
+    def split(self, keep_source=False):
+        if self.layout == 'zip':
+            # Split lists name archive members, nothing is extracted
+            write_split_lists(self.archive_path, self.output_dir, strategy=self.split_strategy)
+            return True
+        splitter = DatasetSplitter(self.extracted_folder_path, output_dir=self.output_dir, keep_source=keep_source,
+                                   mode=self.materialize, layout=self.layout, strategy=self.split_strategy,
+                                   dedupe=self.dedupe)
+        splitter.organize_data()
+        if self.image_cache:
+            from imagecache import ImageCache
+            image_paths = [path for split in SPLITS for path in split_images(splitter.split_source(split))]
+            ImageCache.build(image_paths, self.image_cache_dir, imgsz=self.imgsz)
+        return True
+
+    def sync(self):
+        """Patch the extracted dataset from Label Studio in place"""
+        counts = LabelStudioSync(self.ls_ids[0], target_dir=self.extracted_folder_path).sync()
+        if counts['failed']:
+            logger.warning(f"{counts['failed']} tasks failed to sync and will be retried on the next run")
+        return counts
+
+    def download(self):
+        if self.syncing:
+            # Already synced before fingerprinting
+            return True
+        return download_and_unzip(self.LS, extract=self.layout != 'zip', merge=False)
+
+    def merge(self):
+        if not self.multi_project:
+            return True
+        return merge_projects(self.max_per_class)
+
+    def training_profile(self):
+        """The saved throughput profile for this host, model and imgsz, tuning one first if asked to"""
+        profile = load_profile(self.model, self.imgsz)
+        if profile is None and self.tune:
+            if self.layout == 'zip':
+                logger.warning("Throughput tuning doesn't support the zip layout, using the defaults.")
+                return None
+            try:
+                profile = ThroughputTuner(self.model, data_config=self.data_config, imgsz=self.imgsz).tune()
+            except RuntimeError as e:
+                logger.warning(f"Throughput tuning failed ({e}), using the defaults.")
+                return None
+        return profile
+
+    def train(self, state, train_fingerprint):
+        """Train under a run name derived from the fingerprint, resuming that run if it was interrupted"""
+        name = f"pipeline-{train_fingerprint}"
+        last = os.path.join(self.runs_dir, name, 'weights', 'last.pt')
+        record = state.get('train', {})
+        resume = (record.get('fingerprint') == train_fingerprint and record.get('status') == 'running'
+                  and os.path.exists(last))
+        state['train'] = {'fingerprint': train_fingerprint, 'status': 'running', 'run': name}
+        self.save_state(state)
+
+        image_cache = self.image_cache_dir if self.image_cache and os.path.exists(self.image_cache_dir) else None
+        archive = self.archive_path if self.layout == 'zip' else None
+        batch_size, workers, cache, threads = self.batch_size, None, False, None
+        profile = self.training_profile()
+        if profile is not None:
+            logger.info(f"Using the tuned profile for host {profile['fingerprint']} "
+                         f"({profile['images_per_sec']:.1f} img/s when tuned)")
+            workers, threads = profile['workers'], profile['threads']
+            if not self.batch_size_given:
+                batch_size = profile['batch']
+            # The image cache and the archive replace ultralytics' own caching
+            if image_cache is None and archive is None:
+                cache = profile['cache']
+        train_overrides = dict(project=self.runs_dir, name=name, exist_ok=True)
+        if resume:
+            logger.info(f"Resuming the interrupted run {name} from {last}")
+            train_overrides['resume'] = True
+        trainer = YOLOTrainer(last if resume else self.model, data_config=self.data_config, epochs=self.epochs,
+                              batch_size=batch_size, imgsz=self.imgsz, image_cache=image_cache, archive=archive,
+                              workers=workers, cache=cache, threads=threads, train_overrides=train_overrides)
+        if trainer.start_training() is None:
+            return False
+        self.best_weights = trainer.best_weights
+        return True
+
+    def export_int8(self, state):
+        """Quantize the trained best.pt; a model that fails the gate is reported, not an error"""
+        from quantize import INT8Quantizer
+        report = INT8Quantizer(state['train']['best'], data_config=self.data_config, imgsz=self.imgsz,
+                               max_map_drop=self.max_map_drop, min_speedup=self.min_speedup).run()
+        self.quantization_report = report
+        return True
+
+    def run_stage(self, stage, state, fingerprints, remote):
+        start = time.monotonic()
+        logger.info(f"Stage '{stage}' started")
+        with instrument.stage(stage, fingerprint=fingerprints[stage]) as record:
+            if stage == 'download':
+                ok = self.download()
+            elif stage == 'merge':
+                ok = self.merge()
+            elif stage == 'yaml':
+                ok = self.write_config()
+            elif stage == 'split':
+                ok = self.split(keep_source=self.syncing)
+            elif stage == 'train':
+                ok = self.train(state, fingerprints['train'])
             else:
-                logging.warning("LS_ID not provided correctly. Skipping dataset download and split.")
-                return
+                ok = self.export_int8(state)
+            if not ok:
+                record['status'] = 'error'
+        if not ok:
+            logger.error(f"Stage '{stage}' failed, later stages are skipped.")
+            return False
+        state[stage] = {'fingerprint': fingerprints[stage], 'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        if stage == 'download' and remote is not None:
+            state[stage]['remote'] = remote
+        if stage == 'train':
+            state[stage].update(status='done', run=f"pipeline-{fingerprints['train']}", best=self.best_weights)
+        if stage == 'quantize':
+            state[stage].update(published=self.quantization_report['published'],
+                                rejected=self.quantization_report['rejected'])
+        self.save_state(state)
+        logger.info(f"Stage '{stage}' ✅ in {time.monotonic() - start:.1f}s")
+        return True
+
+    def run(self):
+        if not self.instrumented:
+            return self.run_stages()
+        instrument.activate(Instrumentation(profile_stage=self.profile_stage))
+        try:
+            with instrument.stage('pipeline') as record:
+                ok = self.run_stages()
+                if not ok:
+                    record['status'] = 'error'
+                return ok
+        finally:
+            instrument.activate(None)
 
-        # Train the model
-        trainer = YOLOTrainer(self.model, data_config=self.data_config, epochs=self.epochs, batch_size=self.batch_size)
-        trainer.start_training()
+    def run_stages(self):
+        """Run every stale stage in order; False if the pipeline can't start or a stage failed"""
+        state = self.load_state()
+        if self.layout == 'zip' and self.quantize:
+            logger.error("Quantization calibrates on extracted validation images, it doesn't support the zip layout.")
+            return False
+        if self.layout == 'zip' and self.dedupe:
+            logger.error("Deduplication needs extracted images, it doesn't support the zip layout.")
+            return False
+        if self.LS is not None and (isinstance(self.LS, list) or isinstance(self.LS, int)):
+            if self.layout == 'zip' and self.multi_project:
+                logger.error("Training from the export archive supports a single LS_ID.")
+                return False
+            if self.incremental and not self.syncing:
+                logger.warning("Incremental sync needs a single LS_ID and an extracted dataset, "
+                                "falling back to a full export.")
+            try:
+                if self.syncing:
+                    self.sync()
+                fingerprints, remote = self.fingerprints(state)
+            except Exception as e:
+                logger.error(f"Couldn't read the projects from Label Studio: {e}")
+                return False
+            stages = STAGES
+        elif os.path.exists(self.output_dir):
+            logger.info(f"LS_ID not provided, training on the existing '{self.output_dir}'.")
+            if not os.path.exists(self.data_config):
+                logger.error("Please create the config file")
+                return False
+            logger.info("Config file exists")
+            fingerprints = {}
+            # Keyed on the data the config points at, so new splits train again
+            self.chain_training(fingerprints, fingerprint('local', self.config_digest()))
+            remote, stages = None, ('train',)
+        else:
+            logger.warning("LS_ID not provided correctly. Skipping dataset download and split.")
+            return False
+        if self.quantize:
+            stages += ('quantize',)
 
+        stale = self.first_stale(stages, state, fingerprints)
+        if stale is None:
+            logger.info("Every stage is up to date, nothing to do.")
+            return True
+        start = self.rerun_from(stages, stale)
+        for i, stage in enumerate(stages):
+            # Everything up to the stale stage reruns, later stages only if their fingerprint changed
+            if i < start or (i > stale and self.is_fresh(stage, state, fingerprints)):
+                logger.info(f"Stage '{stage}' is up to date")
+                continue
+            if not self.run_stage(stage, state, fingerprints, remote):
+                return False
+            if stage == 'split':
+                self.chain_training(fingerprints, self.split_digest())
+        return True
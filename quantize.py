@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import shutil
+import numpy as np
+from logger import logger
+from benchmark import split_source, measure_latency
+from utils import split_images
+
+PUBLISH_DIR = 'deploy'
+
+
+def letterbox(im, imgsz=640):
+    """Resize keeping the aspect ratio and pad to imgsz x imgsz with grey, as ultralytics does for inference"""
+    import cv2
+    h, w = im.shape[:2]
+    r = min(imgsz / h, imgsz / w)
+    nh, nw = round(h * r), round(w * r)
+    if (nh, nw) != (h, w):
+        im = cv2.resize(im, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    top, left = (imgsz - nh) // 2, (imgsz - nw) // 2
+    return cv2.copyMakeBorder(im, top, imgsz - nh - top, left, imgsz - nw - left, cv2.BORDER_CONSTANT,
+                              value=(114, 114, 114))
+
+
+def preprocess(path, imgsz=640):
+    """(1, 3, imgsz, imgsz) float32 RGB input in [0, 1], the tensor the exported model expects"""
+    import cv2
+    im = letterbox(cv2.imread(path), imgsz)
+    return np.ascontiguousarray(im[:, :, ::-1].transpose(2, 0, 1)[None], dtype=np.float32) / 255.0
+
+
+def calibration_reader(input_name, paths, imgsz=640):
+    """An onnxruntime CalibrationDataReader feeding preprocessed images one at a time"""
+    from onnxruntime.quantization import CalibrationDataReader
+
+    class ImageCalibrationReader(CalibrationDataReader):
+        def __init__(self):
+            self.paths = iter(paths)
+
+        def get_next(self):
+            path = next(self.paths, None)
+            return None if path is None else {input_name: preprocess(path, imgsz)}
+
+        def rewind(self):
+            self.paths = iter(paths)
+
+    return ImageCalibrationReader()
+
+
+class INT8Quantizer:
+    """Export a checkpoint to ONNX, quantize it to INT8 and publish it only if it's worth it.
+
+    Activations are calibrated on images of the validation split and the model is
+    quantized statically in QDQ format. Both the FP32 and INT8 models are validated
+    and timed; the INT8 model is copied to `output_dir` only when its mAP50-95 drop
+    stays within `max_map_drop` and its p50 latency is at least `min_speedup` times
+    lower. The report is written next to it either way.
+    """
+
+    def __init__(self, weights, data_config="dataset_path.yaml", imgsz=640, calibration_images=100,
+                 latency_images=50, max_map_drop=0.01, min_speedup=1.5, output_dir=PUBLISH_DIR):
+        self.weights = weights
+        self.data_config = data_config
+        self.imgsz = imgsz
+        self.calibration_images = calibration_images
+        self.latency_images = latency_images
+        self.max_map_drop = max_map_drop
+        self.min_speedup = min_speedup
+        self.output_dir = output_dir
+
+    def val_paths(self):
+        paths = [path for path in split_images(split_source(self.data_config)) if os.path.exists(path)]
+        if not paths:
+            raise FileNotFoundError(f"No validation images on disk for {self.data_config}, calibration needs an "
+                                    f"extracted dataset")
+        return paths
+
+    def export_onnx(self):
+        from ultralytics import YOLO
+        return str(YOLO(self.weights).export(format='onnx', imgsz=self.imgsz, dynamic=False, simplify=True))
+
+    def quantize(self, fp32_path):
+        """Statically quantize fp32_path to <stem>.int8.onnx next to it"""
+        import onnx
+        from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+
+        stem = os.path.splitext(fp32_path)[0]
+        prepared_path, int8_path = f"{stem}.prep.onnx", f"{stem}.int8.onnx"
+        quant_pre_process(fp32_path, prepared_path)
+        fp32 = onnx.load(fp32_path)
+        # Spread the calibration images evenly over the split
+        paths = self.val_paths()
+        paths = paths[::max(1, len(paths) // self.calibration_images)][:self.calibration_images]
+        logger.info(f"Calibrating on {len(paths)} validation images")
+        quantize_static(prepared_path, int8_path, calibration_reader(fp32.graph.input[0].name, paths, self.imgsz),
+                        quant_format=QuantFormat.QDQ, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        per_channel=True, calibrate_method=CalibrationMethod.MinMax)
+        os.remove(prepared_path)
+
+        # Keep ultralytics' metadata (class names, stride, imgsz) so the INT8 model loads like the FP32 one
+        int8 = onnx.load(int8_path)
+        del int8.metadata_props[:]
+        int8.metadata_props.extend(fp32.metadata_props)
+        onnx.save(int8, int8_path)
+        return int8_path
+
+    def evaluate(self, path, images):
+        from ultralytics import YOLO
+        yolo = YOLO(path, task='detect')
+        metrics = yolo.val(data=self.data_config, imgsz=self.imgsz, batch=1, plots=False, verbose=False)
+        latencies = measure_latency(yolo, images, self.imgsz)
+        return {'path': path, 'size_mb': round(os.path.getsize(path) / 2 ** 20, 2), 'map': float(metrics.box.map),
+                'map50': float(metrics.box.map50), 'p50_ms': float(np.percentile(latencies, 50)),
+                'p95_ms': float(np.percentile(latencies, 95))}
+
+    def run(self):
+        """Export, quantize, gate and publish; returns the report"""
+        import cv2
+        start = time.monotonic()
+        fp32_path = self.export_onnx()
+        int8_path = self.quantize(fp32_path)
+        images = [cv2.imread(path) for path in self.val_paths()[:self.latency_images]]
+        fp32, int8 = self.evaluate(fp32_path, images), self.evaluate(int8_path, images)
+
+        map_drop = fp32['map'] - int8['map']
+        speedup = fp32['p50_ms'] / int8['p50_ms']
+        reasons = []
+        if map_drop > self.max_map_drop:
+            reasons.append(f"mAP50-95 dropped by {map_drop:.4f}, budget {self.max_map_drop}")
+        if speedup < self.min_speedup:
+            reasons.append(f"speedup {speedup:.2f}x is below {self.min_speedup}x")
+        report = {'weights': os.path.abspath(self.weights), 'fp32': fp32, 'int8': int8, 'map_drop': map_drop,
+                  'speedup': speedup, 'max_map_drop': self.max_map_drop, 'min_speedup': self.min_speedup,
+                  'published': None, 'rejected': reasons, 'seconds': round(time.monotonic() - start, 1)}
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        if not reasons:
+            report['published'] = os.path.join(self.output_dir, os.path.basename(int8_path))
+            shutil.copy2(int8_path, report['published'])
+            logger.info(f"INT8 model ✅ published to {report['published']}: {speedup:.2f}x faster, "
+                        f"mAP50-95 {int8['map']:.4f} ({-map_drop:+.4f})")
+        else:
+            logger.warning(f"INT8 model not published: {'; '.join(reasons)}")
+        with open(os.path.join(self.output_dir, 'quantization_report.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
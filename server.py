@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import asyncio
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from logger import logger
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+            500: 'Internal Server Error', 503: 'Service Unavailable'}
+MAX_BODY = 32 * 2 ** 20
+
+
+class ServerStats:
+    """Request counters and a sliding window of latencies and completion times"""
+
+    def __init__(self, window=10000):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.batches = 0
+        self.batched_images = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.finished_at = collections.deque(maxlen=window)
+
+    def record(self, latency):
+        self.completed += 1
+        self.latencies.append(latency)
+        self.finished_at.append(time.monotonic())
+
+    def snapshot(self, queue_depth, throughput_window=10.0):
+        now = time.monotonic()
+        recent = sum(1 for t in self.finished_at if now - t <= throughput_window)
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        return {'uptime_s': round(now - self.started, 1), 'requests': self.requests, 'completed': self.completed,
+                'rejected': self.rejected, 'failed': self.failed, 'queue_depth': queue_depth,
+                'throughput_rps': round(recent / min(throughput_window, max(now - self.started, 1e-6)), 2),
+                'latency_p50_ms': round(float(p50), 2), 'latency_p95_ms': round(float(p95), 2),
+                'latency_p99_ms': round(float(p99), 2), 'batches': self.batches,
+                'mean_batch_size': round(self.batched_images / self.batches, 2) if self.batches else 0.0}
+
+
+def decode_image(body):
+    """BGR array of an encoded image, None if it can't be decoded"""
+    import cv2
+    return cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def fixed_batch(weights):
+    """The batch size an ONNX export's input is fixed to, None for a dynamic batch or any other format"""
+    if not weights.endswith('.onnx'):
+        return None
+    import onnxruntime
+    session = onnxruntime.InferenceSession(weights, providers=['CPUExecutionProvider'])
+    batch = session.get_inputs()[0].shape[0]
+    return batch if isinstance(batch, int) else None
+
+
+class ModelPool:
+    """Warm YOLO instances, each used by one batch at a time on its own executor thread.
+
+    Works with a .pt checkpoint or an exported model; an ONNX export needs dynamic=True
+    to take batches larger than one, `max_batch` holds the largest batch the model takes.
+    """
+
+    def __init__(self, weights, size=2, imgsz=640, conf=0.25):
+        from ultralytics import YOLO
+        self.weights = weights
+        self.size = size
+        self.imgsz = imgsz
+        self.conf = conf
+        self.max_batch = fixed_batch(weights)
+        if self.max_batch is not None and self.max_batch != 1:
+            raise ValueError(f"{weights} only takes batches of exactly {self.max_batch}, export it with dynamic=True "
+                             f"or batch=1 to serve it")
+        if weights.endswith('.pt'):
+            import torch
+            # Split the cores between the instances instead of letting every one of them use all of them
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // size))
+        self.models = [YOLO(weights, task='detect') for _ in range(size)]
+        warmup = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+        for model in self.models:
+            model.predict(warmup, imgsz=imgsz, verbose=False)
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='model')
+        self.free = None
+
+    async def acquire(self):
+        if self.free is None:
+            self.free = asyncio.Queue()
+            for model in self.models:
+                self.free.put_nowait(model)
+        return await self.free.get()
+
+    def release(self, model):
+        self.free.put_nowait(model)
+
+    def _predict(self, model, images):
+        results = model.predict(images, imgsz=self.imgsz, conf=self.conf, verbose=False)
+        return [[{'class': int(c), 'name': result.names[int(c)], 'confidence': round(float(p), 4),
+                  'box': [round(float(v), 1) for v in xyxy]}
+                 for xyxy, p, c in zip(result.boxes.xyxy.tolist(), result.boxes.conf.tolist(),
+                                       result.boxes.cls.tolist())]
+                for result in results]
+
+    async def predict(self, model, images):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._predict, model, images)
+
+
+class MicroBatcher:
+    """Coalesce concurrent requests into batches of up to max_batch images.
+
+    Once a model is free, the batcher waits at most max_latency_ms after the oldest
+    queued request for more to arrive. The queue is bounded: when it is full a
+    request is rejected immediately instead of waiting.
+    """
+
+    def __init__(self, pool, stats, max_batch=8, max_latency_ms=10, max_queue=256):
+        self.pool = pool
+        self.stats = stats
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms / 1000
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.tasks = set()
+
+    def submit(self, image):
+        """Future of the image's detections; raises asyncio.QueueFull when the server is saturated"""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((image, future, time.monotonic()))
+        return future
+
+    async def run(self):
+        while True:
+            model = await self.pool.acquire()
+            batch = [await self.queue.get()]
+            deadline = batch[0][2] + self.max_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    # Past the deadline, only what is already queued joins the batch
+                    item = await asyncio.wait_for(self.queue.get(), timeout) if timeout > 0 else self.queue.get_nowait()
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+                batch.append(item)
+            task = asyncio.create_task(self.dispatch(model, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def dispatch(self, model, batch):
+        self.stats.batches += 1
+        self.stats.batched_images += len(batch)
+        try:
+            results = await self.pool.predict(model, [image for image, _, _ in batch])
+            for (_, future, _), detections in zip(batch, results):
+                if not future.done():
+                    future.set_result(detections)
+        except Exception as e:
+            logger.error(f"Batch of {len(batch)} failed: {e}")
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.pool.release(model)
+
+
+class InferenceServer:
+    """Minimal HTTP/1.1 server: POST /predict with an encoded image as the body, GET /metrics, GET /healthz"""
+
+    def __init__(self, weights, host='127.0.0.1', port=8000, workers=2, max_batch=8, max_latency_ms=10,
+                 max_queue=256, imgsz=640, conf=0.25):
+        self.host = host
+        self.port = port
+        self.stats = ServerStats()
+        logger.info(f"Loading {workers} warm instance(s) of {weights}")
+        self.pool = ModelPool(weights, size=workers, imgsz=imgsz, conf=conf)
+        if self.pool.max_batch is not None and max_batch > self.pool.max_batch:
+            logger.warning(f"{weights} has a static batch size of {self.pool.max_batch}, serving without batching; "
+                           f"export it with dynamic=True to batch requests")
+            max_batch = self.pool.max_batch
+        self.batcher = MicroBatcher(self.pool, self.stats, max_batch=max_batch, max_latency_ms=max_latency_ms,
+                                    max_queue=max_queue)
+
+    def metrics_text(self):
+        """Prometheus exposition of the stats"""
+        snapshot = self.stats.snapshot(self.batcher.queue.qsize())
+        return ''.join(f"pyvision_server_{key} {value}\n" for key, value in snapshot.items())
+
+    async def predict(self, body):
+        # Decoding a large image would block every other connection on the event loop
+        image = await asyncio.get_running_loop().run_in_executor(None, decode_image, body)
+        if image is None:
+            return 400, {'error': 'body is not a decodable image'}
+        start = time.monotonic()
+        try:
+            future = self.batcher.submit(image)
+        except asyncio.QueueFull:
+            self.stats.rejected += 1
+            return 503, {'error': 'queue full, retry later'}
+        try:
+            detections = await future
+        except Exception as e:
+            self.stats.failed += 1
+            return 500, {'error': str(e)}
+        self.stats.record(time.monotonic() - start)
+        return 200, {'detections': detections}
+
+    async def route(self, method, path, body):
+        if path == '/predict':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            self.stats.requests += 1
+            return await self.predict(body)
+        if path == '/metrics' and method == 'GET':
+            return 200, self.metrics_text()
+        if path == '/stats' and method == 'GET':
+            return 200, self.stats.snapshot(self.batcher.queue.qsize())
+        if path == '/healthz' and method == 'GET':
+            return 200, {'status': 'ok'}
+        return 404, {'error': f'no route {method} {path}'}
+
+    async def handle(self, reader, writer):
+        """Serve requests on one keep-alive connection until the client closes it"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, payload = 413, {'error': f'body over {MAX_BODY} bytes'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, payload = await self.route(method, path.split('?', 1)[0], body)
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                if isinstance(payload, str):
+                    content, content_type = payload.encode('utf-8'), 'text/plain; version=0.0.4'
+                else:
+                    content, content_type = json.dumps(payload).encode('utf-8'), 'application/json'
+                writer.write(f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+                             f"Content-Length: {len(content)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1')
+                             + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        batcher = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle, self.host, self.port, limit=2 ** 16)
+        logger.info(f"Serving on http://{self.host}:{self.port} (max batch {self.batcher.max_batch}, "
+                    f"max latency {self.batcher.max_latency * 1000:.0f} ms, queue {self.batcher.queue.maxsize})")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.pool.executor.shutdown(wait=False)
+
+    def run(self):
+        asyncio.run(self.serve())
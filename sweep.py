@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import queue
+import random
+import yaml
+import shutil
+import itertools
+import multiprocessing
+from logger import logger
+
+SWEEP_DIR = 'runs/sweep'
+DEFAULT_SPACE = {
+    'optimizer': ['SGD', 'AdamW'],
+    'lr0': [0.01, 0.001],
+    'momentum': [0.9, 0.937],
+}
+_MAP_KEY = 'metrics/mAP50-95(B)'
+
+
+def grid(space):
+    """Every combination of the values in space"""
+    knobs = list(space)
+    return [dict(zip(knobs, values)) for values in itertools.product(*(space[knob] for knob in knobs))]
+
+
+def parse_space(items):
+    """A search space from knob=value,value,... strings, each value read as YAML or a number, e.g. lr0=0.01,1e-3"""
+    space = {}
+    for item in items:
+        knob, sep, values = item.partition('=')
+        if not sep or not knob or not values:
+            raise ValueError(f"Expected knob=value,value,... but got '{item}'")
+        space[knob] = [_parse_value(value) for value in values.split(',')]
+    return space
+
+
+def _parse_value(text):
+    value = yaml.safe_load(text)
+    if isinstance(value, str):
+        # YAML 1.1 leaves exponents without a dot, like 1e-3, as strings
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return value
+
+
+def sample(space, n, seed=46):
+    """n distinct random combinations of the values in space, or all of them if there are fewer"""
+    configs = grid(space)
+    return random.Random(seed).sample(configs, min(n, len(configs)))
+
+
+def _cpu_slices(n):
+    """Split the CPUs this process may use into n disjoint, contiguous sets"""
+    cpus = sorted(os.sched_getaffinity(0))
+    n = min(n, len(cpus))
+    return [cpus[i * len(cpus) // n:(i + 1) * len(cpus) // n] for i in range(n)]
+
+
+def _train_trial(results, trial_id, rung, model, epochs, stop_at, data_config, batch_size, imgsz, overrides, cpus):
+    """Train one trial on its own CPUs up to epoch stop_at of its epochs-long schedule and report its validation mAP"""
+    start = time.monotonic()
+    try:
+        os.sched_setaffinity(0, cpus)
+        from trainer import YOLOTrainer
+
+        def stop_at_rung(fit):
+            # final_eval strips the optimizer out of last.pt, the copy keeps it for resuming on the next rung
+            if fit.epoch + 1 == stop_at < fit.epochs:
+                shutil.copy2(fit.last, fit.wdir / f'rung{rung}.pt')
+                fit.stop = True
+
+        trainer = YOLOTrainer(model, epochs, data_config=data_config, batch_size=batch_size, imgsz=imgsz,
+                              threads=len(cpus), workers=min(len(cpus), 4), train_overrides=overrides)
+        trainer.load_model()
+        trainer.model.add_callback('on_fit_epoch_end', stop_at_rung)
+        trainer.train_model()
+        fit = trainer.model.trainer
+        last = fit.wdir / f'rung{rung}.pt' if stop_at < epochs else fit.last
+        if not last.exists():
+            raise RuntimeError(f"Training stopped before epoch {stop_at}")
+        results.put({'trial': trial_id, 'rung': rung, 'ok': True, 'map': float(fit.metrics[_MAP_KEY]),
+                     'last': str(last), 'best': str(fit.best), 'seconds': time.monotonic() - start})
+    except Exception as e:
+        results.put({'trial': trial_id, 'rung': rung, 'ok': False, 'error': str(e),
+                     'seconds': time.monotonic() - start})
+
+
+class HyperparameterSweep:
+    """Successive halving over training configurations, run as CPU-pinned worker processes.
+
+    Every configuration trains for `min_epochs` on the first rung. After each rung
+    only the best 1/eta by validation mAP50-95 go on, resuming from where they
+    stopped with eta times the epoch budget, until `max_epochs`. Losers are never
+    trained again. Each trial runs one `max_epochs` schedule that is stopped at
+    rung boundaries, so the learning rate, optimizer state and close_mosaic are
+    those of a single uninterrupted run. The leaderboard and the overall best.pt
+    are written to `project`.
+    """
+
+    def __init__(self, model, configs=None, data_config="dataset_path.yaml", batch_size=8, imgsz=640, min_epochs=5,
+                 max_epochs=45, eta=3, max_workers=None, timeout=None, project=SWEEP_DIR):
+        self.model = model
+        self.configs = configs or grid(DEFAULT_SPACE)
+        self.data_config = data_config
+        self.batch_size = batch_size
+        self.imgsz = imgsz
+        self.min_epochs = min_epochs
+        self.max_epochs = max_epochs
+        self.eta = eta
+        cpus = len(os.sched_getaffinity(0))
+        self.max_workers = max_workers or max(1, min(len(self.configs), cpus // 4))
+        # Seconds a single rung of a trial may take before it is killed
+        self.timeout = timeout
+        self.project = os.path.abspath(project)
+
+    def budgets(self):
+        """Cumulative epochs trained by the end of every rung"""
+        budgets = [self.min_epochs]
+        while budgets[-1] * self.eta < self.max_epochs:
+            budgets.append(budgets[-1] * self.eta)
+        if budgets[-1] < self.max_epochs:
+            budgets.append(self.max_epochs)
+        return budgets
+
+    def run_rung(self, trials, rung, budget):
+        """Train every trial up to budget epochs, max_workers at a time, each on its own CPU slice"""
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        free_slots = _cpu_slices(self.max_workers)
+        pending = list(trials)
+        running = {}
+        outcomes = {}
+
+        def finish(trial_id, outcome):
+            if trial_id not in running:
+                return  # Reported just before it was killed, the kill stands
+            process, slot, _ = running.pop(trial_id)
+            process.join(5)
+            free_slots.append(slot)
+            outcomes[trial_id] = outcome
+
+        while pending or running:
+            while pending and free_slots:
+                trial = pending.pop(0)
+                slot = free_slots.pop(0)
+                # Later rungs resume the trial's run from the checkpoint the previous rung stopped at
+                overrides = dict(trial['params'], project=self.project, name=trial['id'], exist_ok=True, plots=False)
+                if trial['weights'] != self.model:
+                    overrides['resume'] = True
+                process = context.Process(target=_train_trial, args=(
+                    results, trial['id'], rung, trial['weights'], self.max_epochs, budget, self.data_config,
+                    self.batch_size, self.imgsz, overrides, slot))
+                process.start()
+                running[trial['id']] = (process, slot, time.monotonic())
+                logger.info(f"Rung {rung}: {trial['id']} {trial['params']} to {budget} epochs on CPUs {slot}")
+            try:
+                outcome = results.get(timeout=1.0)
+                finish(outcome['trial'], outcome)
+                continue
+            except queue.Empty:
+                pass
+            for trial_id, (process, _, started) in list(running.items()):
+                if not process.is_alive() and process.exitcode != 0:
+                    finish(trial_id, {'ok': False, 'error': f'worker exited with code {process.exitcode}'})
+                elif self.timeout and time.monotonic() - started > self.timeout:
+                    process.kill()
+                    finish(trial_id, {'ok': False, 'error': f'killed after {self.timeout}s'})
+        return outcomes
+
+    def run(self):
+        """Run the sweep and return the leaderboard, best first"""
+        start = time.monotonic()
+        os.makedirs(self.project, exist_ok=True)
+        trials = [{'id': f'trial{i:02d}', 'params': params, 'weights': self.model, 'epochs': 0, 'map': None,
+                   'best': None, 'rung': -1, 'history': []} for i, params in enumerate(self.configs)]
+        alive = trials
+        budgets = self.budgets()
+        for rung, budget in enumerate(budgets):
+            outcomes = self.run_rung(alive, rung, budget)
+            for trial in alive:
+                outcome = outcomes[trial['id']]
+                trial['history'].append(dict(outcome, epochs=budget))
+                if outcome['ok']:
+                    trial.update(weights=outcome['last'], epochs=budget, map=outcome['map'], best=outcome['best'],
+                                 rung=rung)
+                else:
+                    logger.warning(f"{trial['id']} failed on rung {rung}: {outcome['error']}")
+            survivors = sorted((t for t in alive if t['history'][-1]['ok']), key=lambda t: t['map'], reverse=True)
+            if rung < len(budgets) - 1:
+                survivors = survivors[:max(1, len(survivors) // self.eta)]
+            promoted = ', '.join(f"{t['id']} ({t['map']:.4f})" for t in survivors)
+            logger.info(f"Rung {rung} done at {budget} epochs, promoting {promoted or 'nothing'}")
+            alive = survivors
+            if not alive:
+                break
+
+        # Trials that got further rank above those stopped earlier, then by mAP
+        leaderboard = sorted(trials, key=lambda t: (t['rung'], t['map'] if t['map'] is not None else -1.0),
+                             reverse=True)
+        leaderboard = [{key: trial[key] for key in ('id', 'params', 'rung', 'epochs', 'map', 'best', 'history')}
+                       for trial in leaderboard]
+        with open(os.path.join(self.project, 'leaderboard.json'), 'w') as f:
+            json.dump({'model': self.model, 'budgets': budgets, 'eta': self.eta,
+                       'seconds': round(time.monotonic() - start, 1), 'trials': leaderboard}, f, indent=2)
+        if leaderboard and leaderboard[0]['best'] and os.path.exists(leaderboard[0]['best']):
+            shutil.copy2(leaderboard[0]['best'], os.path.join(self.project, 'best.pt'))
+            logger.info(f"Sweep winner {leaderboard[0]['id']} {leaderboard[0]['params']} with mAP50-95 "
+                        f"{leaderboard[0]['map']:.4f}, weights in {self.project}/best.pt")
+        else:
+            logger.error("No sweep trial finished successfully.")
+        return leaderboard
@@ -0,0 +1,139 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from labelstudio import LabelStudioSync
+from utils import make_session
+
+TOKEN = 'Token secret'
+
+
+class StandIn:
+    """A Label Studio stand-in: project config, paginated tasks, and image files.
+
+    Like Label Studio, /api/tasks leaves out annotations unless fields=all is passed.
+    Every request's path and Authorization header is recorded.
+    """
+
+    def __init__(self):
+        self.labels = ['car', 'person']
+        self.tasks = {}
+        self.files = {}
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                stand_in.requests.append((url.path, self.headers.get('Authorization')))
+                if url.path.startswith('/api/') and self.headers.get('Authorization') != TOKEN:
+                    return self.reply(401, b'{}')
+                if url.path.startswith('/api/projects/'):
+                    config = {'label': {'type': 'RectangleLabels', 'labels': stand_in.labels}}
+                    return self.reply(200, json.dumps({'parsed_label_config': config}).encode('utf-8'))
+                if url.path == '/api/tasks':
+                    page, size = int(query['page'][0]), int(query['page_size'][0])
+                    tasks = [dict(task) for _, task in sorted(stand_in.tasks.items())]
+                    if query.get('fields') != ['all']:
+                        for task in tasks:
+                            task.pop('annotations', None)
+                    body = {'tasks': tasks[(page - 1) * size:page * size]}
+                    return self.reply(200, json.dumps(body).encode('utf-8'))
+                if url.path in stand_in.files:
+                    return self.reply(200, stand_in.files[url.path])
+                self.reply(404, b'')
+
+            def reply(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def put_task(self, task_id, image, updated_at, label='car', x=10, data_url=None, annotation_updated_at=None):
+        self.files.setdefault(f"/data/{image}", f"{image}@{updated_at}".encode('utf-8'))
+        result = {'value': {'x': x, 'y': 20, 'width': 30, 'height': 40, 'rectanglelabels': [label]}}
+        self.tasks[task_id] = {'id': task_id, 'updated_at': updated_at, 'data': {'image': data_url or f"/data/{image}"},
+                               'annotations': [{'id': task_id * 10, 'updated_at': annotation_updated_at or updated_at,
+                                                'result': [result]}]}
+
+
+@pytest.fixture
+def ls():
+    stand_in = StandIn()
+    yield stand_in
+    stand_in.close()
+
+
+def syncer(ls, target_dir):
+    session = make_session(pool_size=2)
+    session.headers['Authorization'] = TOKEN
+    return LabelStudioSync(1, target_dir=str(target_dir), base_url=ls.url, session=session, page_size=2, max_workers=2)
+
+
+def read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def test_sync_adds_updates_and_deletes(ls, tmp_path):
+    for task_id in (1, 2, 3):
+        ls.put_task(task_id, f"img{task_id}.jpg", '2024-01-01')
+    assert syncer(ls, tmp_path).sync() == {'added': 3, 'updated': 0, 'deleted': 0, 'failed': 0}
+    assert read(tmp_path / 'classes.txt') == 'car\nperson\n'
+    assert read(tmp_path / 'labels' / 'img1.txt') == '0 0.25 0.4 0.3 0.4\n'
+    assert (tmp_path / 'images' / 'img3.jpg').read_bytes() == b'img3.jpg@2024-01-01'
+
+    # Nothing changed upstream, nothing is fetched again
+    ls.requests.clear()
+    assert syncer(ls, tmp_path).sync() == {'added': 0, 'updated': 0, 'deleted': 0, 'failed': 0}
+    assert not [path for path, _ in ls.requests if path.startswith('/data/')]
+
+    # An edited annotation, a deleted task and a new one
+    ls.put_task(1, 'img1.jpg', '2024-01-01', label='person', x=50, annotation_updated_at='2024-02-01')
+    del ls.tasks[2]
+    ls.put_task(4, 'img4.jpg', '2024-02-01')
+    assert syncer(ls, tmp_path).sync() == {'added': 1, 'updated': 1, 'deleted': 1, 'failed': 0}
+    assert read(tmp_path / 'labels' / 'img1.txt') == '1 0.65 0.4 0.3 0.4\n'
+    assert not (tmp_path / 'images' / 'img2.jpg').exists()
+    assert not (tmp_path / 'labels' / 'img2.txt').exists()
+    assert (tmp_path / 'images' / 'img4.jpg').exists()
+
+
+def test_replaced_image_is_downloaded_again(ls, tmp_path):
+    ls.put_task(1, 'img1.jpg', '2024-01-01')
+    syncer(ls, tmp_path).sync()
+
+    # Same basename, new data: the task now points at a new upload
+    ls.files['/v2/img1.jpg'] = b'replacement'
+    ls.put_task(1, 'img1.jpg', '2024-03-01', data_url='/v2/img1.jpg')
+    assert syncer(ls, tmp_path).sync()['updated'] == 1
+    assert (tmp_path / 'images' / 'img1.jpg').read_bytes() == b'replacement'
+
+
+def test_token_is_only_sent_to_label_studio(ls, tmp_path):
+    external = StandIn()
+    try:
+        external.files['/bucket/img1.jpg'] = b'external'
+        ls.put_task(1, 'img1.jpg', '2024-01-01', data_url=f"{external.url}/bucket/img1.jpg?X-Amz-Signature=abc")
+        ls.put_task(2, 'img2.jpg', '2024-01-01')
+        assert syncer(ls, tmp_path).sync()['added'] == 2
+    finally:
+        external.close()
+    assert (tmp_path / 'images' / 'img1.jpg').read_bytes() == b'external'
+    assert external.requests == [('/bucket/img1.jpg', None)]
+    assert ('/data/img2.jpg', TOKEN) in ls.requests
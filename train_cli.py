@@ -1,22 +1,212 @@
 import argparse
-from pipe import FullPipeline
 
-def main():
-    parser = argparse.ArgumentParser(description='Run FullPipeline with specified parameters.')
-    parser.add_argument('--model', type=str, required=True, help='Path to the model file')
-    parser.add_argument('--LS_ID', type=int, nargs='+', required=True, help='List of LS_ID parameters (at least one required)')
-    parser.add_argument('--epochs', type=int, required=True, help='Number of epochs')
-    parser.add_argument('--batch_size', type=int, required=True, help='Batch size')
+# Each command imports what it needs when it runs, so the data commands start without torch or ultralytics.
+
+
+def download(args):
+    from utils import download_and_unzip
+    ok = download_and_unzip(args.LS_ID, Type=args.type, max_workers=args.max_workers, attempts=args.attempts,
+                            max_per_class=args.max_per_class, extract=not args.keep_zip, merge=not args.no_merge)
+    return 0 if ok else 1
+
+
+def split(args):
+    if args.layout == 'zip':
+        from logger import logger
+        from zipdataset import write_split_lists
+        if args.dedupe:
+            logger.error("Deduplication needs extracted images, it doesn't support the zip layout.")
+            return 1
+        write_split_lists(args.archive, args.output_dir, split_ratios=tuple(args.ratios), seed=args.seed,
+                          strategy=args.strategy)
+        return 0
+    from datasetsplitter import DatasetSplitter
+    splitter = DatasetSplitter(args.source, split_ratios=tuple(args.ratios), output_dir=args.output_dir,
+                               keep_source=args.keep_source, mode=args.mode, layout=args.layout, seed=args.seed,
+                               strategy=args.strategy, dedupe=args.dedupe)
+    splitter.organize_data()
+    return 0
+
+
+def yaml(args):
+    from datasetyaml import DatasetYamlWriter
+    class_names = None
+    if args.layout == 'zip':
+        # The archive is never extracted, so there is no data/classes.txt
+        from zipdataset import ZipArchive
+        class_names = ZipArchive(args.archive).class_names()
+    DatasetYamlWriter(output_file=args.output_file, layout=args.layout, output_dir=args.output_dir,
+                      class_names=class_names).write_yaml()
+    return 0
+
+
+def train(args):
+    from pipe import FullPipeline
+    pipeline = FullPipeline(model=args.model, LS=args.LS_ID, epochs=args.epochs, batch_size=args.batch_size,
+                            incremental=args.incremental, materialize=args.mode, layout=args.layout,
+                            split_strategy=args.strategy, max_per_class=args.max_per_class, dedupe=args.dedupe,
+                            image_cache=args.image_cache, imgsz=args.imgsz, tune=args.tune,
+                            quantize=args.quantize, max_map_drop=args.max_map_drop, min_speedup=args.min_speedup,
+                            instrumented=args.instrument, profile_stage=args.profile_stage)
+    return 0 if pipeline.run() else 1
+
+
+def val(args):
+    from ultralytics import YOLO
+    metrics = YOLO(args.weights).val(data=args.data, imgsz=args.imgsz, batch=args.batch_size)
+    print(f"mAP50-95: {metrics.box.map:.4f}  mAP50: {metrics.box.map50:.4f}")
+    return 0
+
+
+def sweep(args):
+    from sweep import HyperparameterSweep, DEFAULT_SPACE, grid, parse_space, sample
+    space = parse_space(args.space) if args.space else DEFAULT_SPACE
+    configs = sample(space, args.samples, seed=args.seed) if args.samples else grid(space)
+    leaderboard = HyperparameterSweep(args.model, configs=configs, data_config=args.data, batch_size=args.batch_size,
+                                      imgsz=args.imgsz, min_epochs=args.min_epochs, max_epochs=args.max_epochs,
+                                      eta=args.eta, max_workers=args.workers, timeout=args.timeout,
+                                      project=args.project).run()
+    for trial in leaderboard:
+        score = f"{trial['map']:.4f}" if trial['map'] is not None else 'failed'
+        print(f"{trial['id']}  mAP50-95 {score}  {trial['epochs']} epochs  {trial['params']}")
+    return 0 if leaderboard and leaderboard[0]['map'] is not None else 1
+
 
-    args = parser.parse_args()
+def bench(args):
+    from benchmark import BenchmarkSuite
+    suite = BenchmarkSuite(args.weights, data_config=args.data, imgsz=args.imgsz, formats=args.formats,
+                           images=args.images, history_path=args.history, family=args.family)
+    records = suite.run()
+    failed = any(not record['ok'] for record in records)
+    regressed = any(record['flags'] for record in records)
+    return 1 if failed or (args.fail_on_regression and regressed) else 0
 
-    if not args.LS_ID:
-        parser.error("The --LS_ID parameter requires at least one value.")
 
-    pipeline = FullPipeline(model=args.model, LS_ID=args.LS_ID, epochs=args.epochs, batch_size=args.batch_size)
-    pipeline.run()
+def serve(args):
+    from server import InferenceServer
+    InferenceServer(args.weights, host=args.host, port=args.port, workers=args.workers, max_batch=args.max_batch,
+                    max_latency_ms=args.max_latency_ms, max_queue=args.max_queue, imgsz=args.imgsz,
+                    conf=args.conf).run()
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Label Studio to YOLO pipeline: download, split, train and evaluate.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('download', help='Download (and merge) Label Studio exports into data/')
+    p.add_argument('--LS_ID', type=int, nargs='+', required=True, help='Label Studio project ids')
+    p.add_argument('--type', default='YOLO', help='Export type')
+    p.add_argument('--max_workers', type=int, default=4, help='Projects downloaded concurrently')
+    p.add_argument('--attempts', type=int, default=4, help='Attempts per project')
+    p.add_argument('--max_per_class', type=int, default=None, help='Cap on instances per class when merging')
+    p.add_argument('--keep_zip', action='store_true', help='Keep a single export as data.zip instead of extracting')
+    p.add_argument('--no_merge', action='store_true', help='Leave several projects in _temp/ without merging')
+    p.set_defaults(func=download)
+
+    p = commands.add_parser('split', help='Split an extracted dataset or an export archive into train/valid/test')
+    p.add_argument('--source', default='data', help='Extracted dataset with images/ and labels/')
+    p.add_argument('--archive', default='data.zip', help='Export archive split with --layout zip')
+    p.add_argument('--output_dir', default='datasets')
+    p.add_argument('--ratios', type=float, nargs=3, default=[0.95, 0.025, 0.025], help='Train, valid, test')
+    p.add_argument('--layout', default='tree', choices=['tree', 'manifest', 'zip'])
+    p.add_argument('--mode', default='auto', choices=['auto', 'reflink', 'hardlink', 'symlink', 'rename', 'copy'])
+    p.add_argument('--strategy', default='hash', choices=['hash', 'stratified', 'shuffle'])
+    p.add_argument('--dedupe', default=None, choices=['drop', 'group'])
+    p.add_argument('--seed', type=int, default=46)
+    p.add_argument('--keep_source', action='store_true', help='Keep the extracted dataset after splitting')
+    p.set_defaults(func=split)
+
+    p = commands.add_parser('yaml', help='Write the dataset config for the splits')
+    p.add_argument('--output_file', default='dataset_path.yaml')
+    p.add_argument('--output_dir', default='datasets')
+    p.add_argument('--layout', default='tree', choices=['tree', 'manifest', 'zip'])
+    p.add_argument('--archive', default='data.zip', help='Export archive the class names are read from with --layout zip')
+    p.set_defaults(func=yaml)
+
+    p = commands.add_parser('train', help='Run the full pipeline and train')
+    p.add_argument('--model', type=str, required=True, help='Path to the model file')
+    p.add_argument('--LS_ID', type=int, nargs='+', default=None,
+                   help='Label Studio project ids, omit to train on the existing datasets/')
+    p.add_argument('--epochs', type=int, default=None, help='Number of epochs')
+    p.add_argument('--batch_size', type=int, default=None, help='Batch size')
+    p.add_argument('--imgsz', type=int, default=640)
+    p.add_argument('--layout', default='tree', choices=['tree', 'manifest', 'zip'])
+    p.add_argument('--mode', default='auto', choices=['auto', 'reflink', 'hardlink', 'symlink', 'rename', 'copy'])
+    p.add_argument('--strategy', default='hash', choices=['hash', 'stratified', 'shuffle'])
+    p.add_argument('--max_per_class', type=int, default=None)
+    p.add_argument('--dedupe', default=None, choices=['drop', 'group'])
+    p.add_argument('--incremental', action='store_true', help='Sync a single project in place')
+    p.add_argument('--image_cache', action='store_true', help='Train from a pre-decoded image cache')
+    p.add_argument('--tune', action='store_true', help='Tune batch size, workers and cache for this host first')
+    p.add_argument('--quantize', action='store_true', help='Publish an INT8 ONNX model if it passes the gate')
+    p.add_argument('--max_map_drop', type=float, default=0.01, help='Most mAP50-95 the INT8 model may lose')
+    p.add_argument('--min_speedup', type=float, default=1.5, help='Least p50 latency speedup the INT8 model must bring')
+    p.add_argument('--instrument', action='store_true',
+                   help='Write per-stage metrics to pipeline_events.jsonl and pipeline.prom')
+    p.add_argument('--profile_stage', default=None,
+                   choices=['download', 'extract', 'merge', 'yaml', 'split', 'dedupe', 'train', 'quantize'],
+                   help='Run a sampling profiler during this stage')
+    p.set_defaults(func=train)
+
+    p = commands.add_parser('sweep', help='Search training hyperparameters with successive halving')
+    p.add_argument('--model', required=True, help='Path to the model file')
+    p.add_argument('--data', default='dataset_path.yaml')
+    p.add_argument('--space', nargs='+', default=None, metavar='KNOB=V1,V2',
+                   help='Values to search per ultralytics train argument, e.g. lr0=0.01,0.001 optimizer=SGD,AdamW')
+    p.add_argument('--samples', type=int, default=None, help='Random configurations to try instead of the full grid')
+    p.add_argument('--seed', type=int, default=46)
+    p.add_argument('--min_epochs', type=int, default=5, help='Epochs every configuration trains on the first rung')
+    p.add_argument('--max_epochs', type=int, default=45, help='Epochs the final survivors train to')
+    p.add_argument('--eta', type=int, default=3, help='Only the best 1/eta of each rung is promoted')
+    p.add_argument('--workers', type=int, default=None, help='Trials trained concurrently, each on its own CPUs')
+    p.add_argument('--timeout', type=float, default=None, help='Seconds a trial may spend on one rung')
+    p.add_argument('--batch_size', type=int, default=8)
+    p.add_argument('--imgsz', type=int, default=640)
+    p.add_argument('--project', default='runs/sweep', help='Where the trials, leaderboard.json and best.pt go')
+    p.set_defaults(func=sweep)
+
+    p = commands.add_parser('val', help='Validate trained weights')
+    p.add_argument('--weights', required=True)
+    p.add_argument('--data', default='dataset_path.yaml')
+    p.add_argument('--imgsz', type=int, default=640)
+    p.add_argument('--batch_size', type=int, default=16)
+    p.set_defaults(func=val)
+
+    p = commands.add_parser('bench', help='Benchmark trained weights across export formats')
+    p.add_argument('--weights', required=True)
+    p.add_argument('--data', default='dataset_path.yaml')
+    p.add_argument('--imgsz', type=int, default=640)
+    p.add_argument('--formats', nargs='+', default=['pytorch', 'torchscript', 'onnx', 'openvino'],
+                   choices=['pytorch', 'torchscript', 'onnx', 'openvino'])
+    p.add_argument('--images', type=int, default=50, help='Validation images timed per format')
+    p.add_argument('--history', default='benchmarks.jsonl', help='Append-only benchmark history')
+    p.add_argument('--family', default=None, help='Model family to compare against, read from the checkpoint by default')
+    p.add_argument('--fail_on_regression', action='store_true', help='Exit with 1 when a regression is flagged')
+    p.set_defaults(func=bench)
+
+    p = commands.add_parser('serve', help='Serve trained weights over HTTP with micro-batching')
+    p.add_argument('--weights', required=True, help='best.pt or an exported model')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8000)
+    p.add_argument('--workers', type=int, default=2, help='Warm model instances')
+    p.add_argument('--max_batch', type=int, default=8)
+    p.add_argument('--max_latency_ms', type=float, default=10, help='Longest a request waits for its batch to fill')
+    p.add_argument('--max_queue', type=int, default=256, help='Queued requests before answering 503')
+    p.add_argument('--imgsz', type=int, default=640)
+    p.add_argument('--conf', type=float, default=0.25)
+    p.set_defaults(func=serve)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    return args.func(args)
 
 if __name__ == '__main__':
-    main()
+    raise SystemExit(main())
 
-#python /home/yupcha/Desktop/project/pipeline/test.py --model <path_to_model> --LS_ID <LS_ID_value1> <LS_ID_value2> ... --epochs <number_of_epochs> --batch_size <batch_size_value>
+#python train_cli.py train --model <path_to_model> --LS_ID <LS_ID_value1> <LS_ID_value2> ... --epochs <number_of_epochs> --batch_size <batch_size_value>
+#python train_cli.py download --LS_ID <LS_ID_value> && python train_cli.py split --layout manifest && python train_cli.py yaml --layout manifest
+#python train_cli.py download --LS_ID <LS_ID_value> --keep_zip && python train_cli.py split --layout zip && python train_cli.py yaml --layout zip
+#python train_cli.py sweep --model <path_to_model> --space lr0=0.01,0.001 optimizer=SGD,AdamW --min_epochs 5 --max_epochs 45
@@ -1,28 +1,44 @@
 import os
 import shutil
-import logging
-from sklearn.model_selection import train_test_split
-from ultralytics import YOLO
-import torch
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+import instrument
+from logger import logger
 
 class YOLOTrainer:
-    def __init__(self, model, epochs, data_config="dataset_path.yaml", batch_size=8):
+    def __init__(self, model, epochs, data_config="dataset_path.yaml", batch_size=8, imgsz=640, image_cache=None,
+                 archive=None, workers=None, cache=False, threads=None, train_overrides=None):
         self.model_path = model
         self.data_config = data_config
         self.epochs = epochs
         self.batch_size = batch_size
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.imgsz = imgsz
+        # Directory of an ImageCache to read pre-decoded images from instead of the JPEG files
+        self.image_cache = image_cache
+        # Export zip whose members the data config's split lists name, read without extracting
+        self.archive = archive
+        # Dataloader workers, ultralytics' cache mode and torch threads, usually from a tuned profile
+        self.workers = workers
+        self.cache = cache
+        self.threads = threads
+        # Extra ultralytics train arguments that replace the defaults of train_model, e.g. optimizer or lr0
+        self.train_overrides = train_overrides or {}
+        self.device = None
         self.model = None
+        # Path of the best checkpoint once training has finished
+        self.best_weights = None
 
     def load_model(self):
         """Load the YOLO model"""
+        # torch and ultralytics are only imported once training actually starts
+        import torch
+        from ultralytics import YOLO
+
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         try:
             logger.info(f"Loading model from {self.model_path}...")
             self.model = YOLO(self.model_path)
+            # Per-epoch events when the pipeline is instrumented
+            for event, callback in instrument.training_callbacks().items():
+                self.model.add_callback(event, callback)
             logger.info(f"Model loaded successfully on {self.device}.")
         except FileNotFoundError:
             logger.error(f"Model file not found at {self.model_path}.")
@@ -38,8 +54,23 @@ class YOLOTrainer:
 
         try:
             logger.info(self.data_config)
-            results = self.model.train(data=self.data_config, epochs=self.epochs, batch=self.batch_size , optimizer='SGD',lr0=0.01,seed=42,momentum=0.9)
-            logger.info("Training completed successfully.")
+            train_args = dict(data=self.data_config, epochs=self.epochs, batch=self.batch_size, imgsz=self.imgsz,
+                              optimizer='SGD', lr0=0.01, seed=42, momentum=0.9, cache=self.cache)
+            if self.workers is not None:
+                train_args['workers'] = self.workers
+            train_args.update(self.train_overrides)
+            if self.threads is not None:
+                import torch
+                torch.set_num_threads(self.threads)
+            if self.archive is not None:
+                from zipdataset import zip_trainer
+                train_args['trainer'] = zip_trainer(self.archive)
+            elif self.image_cache is not None:
+                from imagecache import cached_trainer
+                train_args['trainer'] = cached_trainer(self.image_cache)
+            results = self.model.train(**train_args)
+            self.best_weights = str(self.model.trainer.best)
+            logger.info(f"Training completed successfully, best weights in {self.best_weights}.")
             return results
         except FileNotFoundError:
             logger.error(f"Data configuration file not found at {self.data_config}.")
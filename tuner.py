@@ -0,0 +1,232 @@
+import os
+import json
+import math
+import time
+import yaml
+import queue
+import random
+import shutil
+import hashlib
+import platform
+import resource
+import tempfile
+import multiprocessing
+from PIL import Image
+from logger import logger
+from instrument import peak_rss_mb, live_children_peak_rss_mb
+from utils import split_images
+
+PROFILE_FILE = 'tuning_profiles.json'
+# Searched one knob at a time, in this order, starting from the first value of each list
+DEFAULT_SPACE = {
+    'threads': [os.cpu_count() or 1, max(1, (os.cpu_count() or 2) // 2)],
+    'batch': [8, 4, 16, 32],
+    'workers': [min(8, os.cpu_count() or 1), 0, 2, 4],
+    'cache': [False, 'ram', 'disk'],
+}
+
+
+def host_fingerprint():
+    """Short id of this host's hardware and training stack, plus the details it was built from"""
+    info = {
+        'node': platform.node(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'memory': os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'),
+        'python': platform.python_version(),
+    }
+    try:
+        import torch
+        info['torch'] = torch.__version__
+        info['cuda'] = torch.cuda.is_available()
+    except ImportError:
+        pass
+    digest = hashlib.sha1(json.dumps(info, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return digest, info
+
+
+def profile_key(model, imgsz, fingerprint=None):
+    """Key of a tuned profile: the host, the model and the image size, which all change what fits in memory"""
+    return f"{fingerprint or host_fingerprint()[0]}:{os.path.basename(model)}:{imgsz}"
+
+
+def load_profile(model, imgsz, path=PROFILE_FILE, fingerprint=None):
+    """The profile tuned on this host for model at imgsz, or None if it was never tuned"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        profiles = json.load(f)
+    return profiles.get(profile_key(model, imgsz, fingerprint))
+
+
+def save_profile(profile, path=PROFILE_FILE):
+    profiles = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            profiles = json.load(f)
+    profiles[profile['key']] = profile
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def train_images(data_config):
+    """Training images named by a dataset YAML, for either a folder or a list file"""
+    with open(data_config, 'r') as f:
+        return split_images(yaml.safe_load(f)['train'])
+
+
+def ram_cache_mb(image_paths, imgsz, samples=32, seed=46):
+    """Memory cache='ram' takes for all of image_paths, extrapolated from the header sizes of a sample
+
+    Ultralytics keeps every image resized to imgsz on its long side as uint8 BGR.
+    """
+    if not image_paths:
+        return 0.0
+    sample = random.Random(seed).sample(image_paths, min(samples, len(image_paths)))
+    total = 0
+    for path in sample:
+        with Image.open(path) as image:
+            w0, h0 = image.size
+        r = imgsz / max(h0, w0)
+        total += min(math.ceil(h0 * r), imgsz) * min(math.ceil(w0 * r), imgsz) * 3
+    return total / len(sample) * len(image_paths) / 2 ** 20
+
+
+class _TrialDone(Exception):
+    pass
+
+
+def _run_trial(results, model, data_config, imgsz, params, steps, warmup, fraction, project):
+    """Train for a few timed steps with params and report images/sec and peak RSS"""
+    # Dataloader workers are still running when the trial stops, so their peak is sampled every batch
+    workers_peak = [0.0]
+
+    def trial_peak_rss_mb():
+        return peak_rss_mb() + max(workers_peak[0], peak_rss_mb(resource.RUSAGE_CHILDREN))
+
+    try:
+        import torch
+        from ultralytics import YOLO
+
+        torch.set_num_threads(params['threads'])
+        stamps = []
+
+        def on_train_batch_end(trainer):
+            stamps.append(time.perf_counter())
+            workers_peak[0] = max(workers_peak[0], live_children_peak_rss_mb())
+            if len(stamps) > warmup + steps:
+                raise _TrialDone()
+
+        yolo = YOLO(model)
+        yolo.add_callback('on_train_batch_end', on_train_batch_end)
+        try:
+            yolo.train(data=data_config, epochs=1, imgsz=imgsz, batch=params['batch'], workers=params['workers'],
+                       cache=params['cache'], fraction=fraction, val=False, plots=False, save=False,
+                       project=project, name='trial', exist_ok=True, verbose=False)
+        except _TrialDone:
+            pass
+        timed = stamps[warmup:]
+        if len(timed) < 2:
+            raise RuntimeError(f"Only {len(stamps)} batches ran, increase the dataset fraction")
+        images_per_sec = params['batch'] * (len(timed) - 1) / (timed[-1] - timed[0])
+        results.put({'ok': True, 'images_per_sec': images_per_sec, 'peak_rss_mb': trial_peak_rss_mb()})
+    except Exception as e:
+        results.put({'ok': False, 'error': str(e), 'peak_rss_mb': trial_peak_rss_mb()})
+
+
+class ThroughputTuner:
+    """Find the batch size, dataloader workers, cache mode and torch threads that train fastest here.
+
+    Every trial runs a handful of timed training steps in a fresh process, so its
+    peak RSS is measured on its own. Knobs are searched one at a time: each keeps
+    the best value found so far while the next one is varied. Trials above the
+    memory ceiling are rejected; a cache='ram' trial is charged for caching the
+    whole training split, not just the fraction it ran on. The winner is saved
+    per host fingerprint, model and image size.
+    """
+
+    def __init__(self, model, data_config="dataset_path.yaml", imgsz=640, space=None, steps=10, warmup=3,
+                 memory_limit_mb=None, timeout=600, profile_path=PROFILE_FILE):
+        self.model = model
+        self.data_config = data_config
+        self.imgsz = imgsz
+        self.space = space or DEFAULT_SPACE
+        self.steps = steps
+        self.warmup = warmup
+        # Defaults to 80% of physical memory
+        self.memory_limit_mb = memory_limit_mb or os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.8 / 2 ** 20
+        self.timeout = timeout
+        self.profile_path = profile_path
+        self.trials = []
+        # Estimated cache='ram' footprint of the whole training split, set by tune()
+        self.ram_cache_mb = 0.0
+
+    def run_trial(self, params, num_images):
+        fraction = min(1.0, (self.steps + self.warmup + 2) * params['batch'] / max(num_images, 1))
+        context = multiprocessing.get_context('spawn')  # A clean process, torch's thread pools don't survive fork
+        results = context.Queue()
+        project = tempfile.mkdtemp(prefix='tune-')
+        process = context.Process(target=_run_trial, args=(results, self.model, self.data_config, self.imgsz, params,
+                                                           self.steps, self.warmup, fraction, project))
+        process.start()
+        started = time.monotonic()
+        result = None
+        while result is None:
+            exited = not process.is_alive()
+            try:
+                # A trial that exited has flushed its result already, if it had one
+                result = results.get(timeout=0.1 if exited else 1.0)
+            except queue.Empty:
+                if exited:
+                    # The OOM killer doesn't let the trial report, don't wait out the timeout
+                    result = {'ok': False, 'error': f'trial exited with code {process.exitcode} (killed or out of memory)'}
+                elif time.monotonic() - started > self.timeout:
+                    result = {'ok': False, 'error': f'no result within {self.timeout}s'}
+        process.join(5)
+        if process.is_alive():
+            process.kill()
+        shutil.rmtree(project, ignore_errors=True)
+        if result['ok'] and params['cache'] in (True, 'ram'):
+            # The trial only cached its fraction of the images, the real run caches all of them
+            result['peak_rss_mb'] += self.ram_cache_mb * (1 - fraction)
+        if result['ok'] and result['peak_rss_mb'] > self.memory_limit_mb:
+            result.update(ok=False, error=f"peak RSS {result['peak_rss_mb']:.0f} MB over the {self.memory_limit_mb:.0f} MB ceiling")
+        result['params'] = dict(params)
+        self.trials.append(result)
+        logger.info(f"Trial {params}: " + (f"{result['images_per_sec']:.1f} img/s, {result['peak_rss_mb']:.0f} MB"
+                                           if result['ok'] else f"rejected ({result['error']})"))
+        return result
+
+    def tune(self):
+        """Search the space, persist the best profile for this host and return it"""
+        image_paths = train_images(self.data_config)
+        num_images = len(image_paths)
+        self.ram_cache_mb = ram_cache_mb(image_paths, self.imgsz)
+        best_params = {knob: values[0] for knob, values in self.space.items()}
+        best = None
+        for knob, values in self.space.items():
+            for value in values:
+                params = dict(best_params, **{knob: value})
+                if best is not None and params == best['params']:
+                    continue
+                result = self.run_trial(params, num_images)
+                if result['ok'] and (best is None or result['images_per_sec'] > best['images_per_sec']):
+                    best = result
+                    best_params = params
+                if not result['ok'] and knob == 'batch' and best is not None and value > best_params['batch']:
+                    # Bigger batches only need more memory
+                    break
+        if best is None:
+            raise RuntimeError("No tuning trial succeeded, see the log for the errors")
+
+        fingerprint, host = host_fingerprint()
+        profile = dict(best_params, key=profile_key(self.model, self.imgsz, fingerprint), fingerprint=fingerprint,
+                       host=host, model=os.path.basename(self.model), imgsz=self.imgsz,
+                       images_per_sec=best['images_per_sec'], peak_rss_mb=best['peak_rss_mb'],
+                       tuned_at=time.strftime('%Y-%m-%dT%H:%M:%S'), trials=self.trials)
+        save_profile(profile, self.profile_path)
+        logger.info(f"Tuned profile for host {fingerprint}: {best_params} at {best['images_per_sec']:.1f} img/s")
+        return profile
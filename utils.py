@@ -1,5 +1,8 @@
 import random
 import os
+import bisect
+import hashlib
+import itertools
 import shutil
 import requests
 from dotenv import load_dotenv
@@ -10,16 +13,116 @@ import json
 import socket
 import time
 import pathlib
+import numpy as np
+import instrument
 from logger import logger
-from io import BytesIO
+from labelindex import LabelIndex
 from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 
-def split_dataset(image_files, label_files, split_ratios, seed=46):
-    """Custom function to split the dataset manually without using sklearn"""
+CHUNK_SIZE = 1 << 20  # 1 MiB per streamed chunk
+
+SPLIT_STRATEGIES = ('hash', 'stratified', 'shuffle')
+IMAGE_EXTENSIONS = ('.jpg', '.png', '.jpeg')
+
+def hash_fraction(key, salt):
+    """Stable position of key in [0, 1) derived from a hash of the salt and key"""
+    digest = hashlib.blake2b(f"{salt}:{key}".encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+def assign_splits(keys, split_ratios, seed=46):
+    """Split index (0 train, 1 valid, 2 test) for every key, decided by the key alone
+
+    Adding or removing other keys never changes where an existing key lands.
+    """
+    bounds = list(itertools.accumulate(split_ratios))[:-1]
+    return [bisect.bisect_right(bounds, hash_fraction(key, seed)) for key in keys]
+
+def _quotas(total, weights, minimum):
+    """Integer split of total proportional to weights (largest remainder), on top of per-split minimums"""
+    weights = np.clip(weights, 0, None)
+    if weights.sum() <= 0:
+        weights = np.ones_like(weights)
+    if minimum.sum() > total:
+        minimum = np.zeros_like(minimum)
+    spare = total - minimum.sum()
+    share = weights / weights.sum() * spare
+    quota = np.floor(share).astype(np.int64)
+    quota[np.argsort(quota - share)[:spare - quota.sum()]] += 1
+    return quota + minimum
+
+def stratified_assign(histogram, split_ratios, seed=46, assigned=None):
+    """Split index for every image so each class is spread over the splits in split_ratios
+
+    Batched iterative stratification: classes are visited rarest first and all
+    still unassigned images of a class are dealt out at once in proportion to
+    how many images of that class each split still wants. Every split with a
+    non-zero ratio gets at least one image of a class when there are enough.
+    Entries of `assigned` that are not -1 are kept as they are.
+    """
+    rng = np.random.default_rng(seed)
+    ratios = np.asarray(split_ratios, dtype=np.float64)
+    present = np.asarray(histogram) > 0
+    n, num_classes = present.shape
+    assignment = np.full(n, -1, dtype=np.int64) if assigned is None else np.array(assigned, dtype=np.int64)
+
+    have = np.stack([present[assignment == split].sum(axis=0) for split in range(len(ratios))])
+    desired = ratios[:, None] * present.sum(axis=0)[None, :] - have
+    capacity = ratios * n - np.bincount(assignment[assignment >= 0], minlength=len(ratios))
+    unassigned = assignment < 0
+    left = present[unassigned].sum(axis=0)
+
+    def place(images, split):
+        assignment[images] = split
+        unassigned[images] = False
+        counts = present[images].sum(axis=0)
+        have[split] += counts
+        desired[split] -= counts
+        capacity[split] -= len(images)
+        left[:] -= counts
+
+    while left.any():
+        label = int(np.argmin(np.where(left > 0, left, np.iinfo(np.int64).max)))
+        candidates = rng.permutation(np.flatnonzero(present[:, label] & unassigned))
+        minimum = ((ratios > 0) & (have[:, label] == 0)).astype(np.int64)
+        quota = _quotas(len(candidates), desired[:, label], minimum)
+        for split, chunk in enumerate(np.split(candidates, np.cumsum(quota)[:-1])):
+            place(chunk, split)
+
+    # Background images only have to respect the overall ratios
+    background = rng.permutation(np.flatnonzero(unassigned))
+    quota = _quotas(len(background), capacity, np.zeros(len(ratios), dtype=np.int64))
+    for split, chunk in enumerate(np.split(background, np.cumsum(quota)[:-1])):
+        place(chunk, split)
+    return assignment
+
+def split_dataset(image_files, label_files, split_ratios, seed=46, strategy='hash', histogram=None, assigned=None):
+    """Custom function to split the dataset manually without using sklearn
+
+    The default 'hash' strategy places each file by a hash of its name, so files
+    keep their split as the dataset grows. 'stratified' needs the per-image class
+    `histogram` (see LabelIndex.image_class_histogram) and keeps the `assigned`
+    splits of files that were placed before. 'shuffle' is the old seeded shuffle
+    where adding one file reshuffles nearly every assignment.
+    """
     try:
         assert sum(split_ratios) == 1, "Split ratios must sum up to 1."
+        assert strategy in SPLIT_STRATEGIES, f"Split strategy must be one of {SPLIT_STRATEGIES}."
+
+        if strategy in ('hash', 'stratified'):
+            if strategy == 'hash':
+                stems = [os.path.splitext(image_file)[0] for image_file in image_files]
+                assignment = assign_splits(stems, split_ratios, seed)
+            else:
+                assert histogram is not None, "The stratified strategy needs a class histogram."
+                assignment = stratified_assign(histogram, split_ratios, seed, assigned)
+            splits = [([], []) for _ in split_ratios]
+            for split, image_file, label_file in zip(assignment, image_files, label_files):
+                splits[split][0].append(image_file)
+                splits[split][1].append(label_file)
+            (train_images, train_labels), (valid_images, valid_labels), (test_images, test_labels) = splits
+            return train_images, train_labels, valid_images, valid_labels, test_images, test_labels
 
         # Ensure reproducibility
         random.seed(seed)
@@ -44,6 +147,18 @@ def split_dataset(image_files, label_files, split_ratios, seed=46):
         logger.error(f"Error in split_dataset: {e}", exc_info=True)
         raise
 
+def split_images(source):
+    """Image paths of a split, from its images folder or from a list file naming one image per line
+
+    Anything else next to the images, such as the .npy files of ultralytics' disk cache, is left out.
+    """
+    if os.path.isdir(source):
+        names = sorted(os.listdir(source))
+        return [os.path.join(source, name) for name in names if name.lower().endswith(IMAGE_EXTENSIONS)]
+    with open(source, 'r') as f:
+        paths = [line.strip() for line in f]
+    return [path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS)]
+
 def check_classes():
     """Check the classes present in the dataset and their counts"""
     try:
@@ -74,45 +189,74 @@ def check_classes():
         logger.error(f"Error in check_classes: {e}", exc_info=True)
         raise
 
-def _take_samples():
+def balanced_sample(histogram, max_per_class, seed=46):
+    """Boolean mask of images that keeps up to max_per_class instances of every class
+
+    Classes are filled rarest first, so images of rare classes are always kept and
+    common classes are only topped up to the cap. Background images count as one
+    more class.
+    """
+    rng = np.random.default_rng(seed)
+    histogram = np.asarray(histogram)
+    histogram = np.column_stack([histogram, histogram.sum(axis=1) == 0]).astype(np.int64)
+    selected = np.zeros(len(histogram), dtype=bool)
+    taken = np.zeros(histogram.shape[1], dtype=np.int64)
+    for label in np.argsort(histogram.sum(axis=0), kind='stable'):
+        need = max_per_class - taken[label]
+        if need <= 0:
+            continue
+        candidates = rng.permutation(np.flatnonzero(~selected & (histogram[:, label] > 0)))
+        enough = np.searchsorted(np.cumsum(histogram[candidates, label]), need) + 1
+        chosen = candidates[:enough]
+        selected[chosen] = True
+        taken += histogram[chosen].sum(axis=0)
+    return selected
+
+def _take_samples(max_per_class=None, seed=46):
+    """Merge every project in _temp into data/, optionally capping the instances per class"""
     try:
         temp_folder = '_temp'
-        subfolders = [f.path for f in os.scandir(temp_folder) if f.is_dir()]
-
-        min_image_count = float('inf')
-        image_counts = {}
+        subfolders = sorted(f.path for f in os.scandir(temp_folder) if f.is_dir())
 
-        # Count the number of images in each subfolder
+        # Index the labels of every project and line the images up with their class histograms
+        entries, histograms = [], []
         for folder in subfolders:
-            image_files = os.listdir(os.path.join(folder, 'images'))
-            image_counts[folder] = image_files
-            min_image_count = min(min_image_count, len(image_files))
-
-        logger.info(f"Minimum image count: {min_image_count}")
-        
-        # Create combined data folder
-        combined_data_folder = os.path.join(temp_folder, '../data')
+            index = LabelIndex.build(os.path.join(folder, 'labels'))
+            row = {stem: i for i, stem in enumerate(index.stems.tolist())}
+            image_files = sorted(os.listdir(os.path.join(folder, 'images')))
+            rows = np.array([row.get(os.path.splitext(image_file)[0], -1) for image_file in image_files], dtype=np.int64)
+            entries.extend((folder, image_file) for image_file in image_files)
+            histograms.append((index, rows))
+        num_classes = max([index.num_classes for index, _ in histograms] + [1])
+        # Row -1 (an image without a label file) lands on an appended all-zero background row
+        background = np.zeros((1, num_classes), dtype=np.int64)
+        histogram = np.concatenate([np.vstack([index.image_class_histogram(num_classes), background])[rows]
+                                    for index, rows in histograms]) if entries else np.zeros((0, num_classes))
+
+        if max_per_class is None:
+            selected = np.ones(len(entries), dtype=bool)
+        else:
+            selected = balanced_sample(histogram, max_per_class, seed)
+        instrument.count(images=int(selected.sum()))
+        logger.info(f"Merging {int(selected.sum())} of {len(entries)} images, instances per class: "
+                    f"{histogram[selected].sum(axis=0).tolist()}")
+
+        # Build the combined data folder next to data/ and swap it in, dropping images no longer selected
+        combined_data_folder = os.path.join(temp_folder, '../data.new')
+        shutil.rmtree(combined_data_folder, ignore_errors=True)
         combined_images_folder = os.path.join(combined_data_folder, 'images')
         combined_labels_folder = os.path.join(combined_data_folder, 'labels')
         os.makedirs(combined_images_folder, exist_ok=True)
         os.makedirs(combined_labels_folder, exist_ok=True)
 
-        # Take min_image_count samples from each subfolder and combine them
-        for subfolder, image_files in image_counts.items():
-            images_path = os.path.join(subfolder, 'images')
-            labels_path = os.path.join(subfolder, 'labels')
-            sampled_images = image_files[:min_image_count]
-
-            for image_file in sampled_images:
-                src_image_path = os.path.join(images_path, image_file)
-                dst_image_path = os.path.join(combined_images_folder, image_file)
-                if src_image_path != dst_image_path:
-                    shutil.copy(src_image_path, dst_image_path)
-                label_file = os.path.splitext(image_file)[0] + '.txt'  # Assuming label files have the same name as image files but with .txt extension
-                src_label_path = os.path.join(labels_path, label_file)
-                dst_label_path = os.path.join(combined_labels_folder, label_file)
-                if src_label_path != dst_label_path:
-                    shutil.copy(src_label_path, dst_label_path)
+        # _temp is removed afterwards, so the selected files can simply be renamed into data/
+        for folder in subfolders:
+            images = [image_file for (entry_folder, image_file), keep in zip(entries, selected)
+                      if keep and entry_folder == folder]
+            labels = [os.path.splitext(image_file)[0] + '.txt' for image_file in images]
+            labels = [label for label in labels if os.path.exists(os.path.join(folder, 'labels', label))]
+            materialize_files(images, os.path.join(folder, 'images'), combined_images_folder, mode='rename')
+            materialize_files(labels, os.path.join(folder, 'labels'), combined_labels_folder, mode='rename')
 
         # Copy classes.txt and notes.json if they exist
         for subfolder in subfolders:
@@ -121,6 +265,7 @@ def _take_samples():
                 dst_file_path = os.path.join(combined_data_folder, file_name)
                 if os.path.exists(src_file_path) and src_file_path != dst_file_path:
                     shutil.copy(src_file_path, dst_file_path)
+        replace_folder(combined_data_folder, os.path.join(temp_folder, '../data'))
 
         # Removes the temp folder after combining
         shutil.rmtree(temp_folder)
@@ -128,12 +273,78 @@ def _take_samples():
         logger.error(f"Error in _take_samples: {e}", exc_info=True)
         raise
 
-def move_files(file_list, source_dir, target_dir):
+MATERIALIZE_MODES = ('auto', 'reflink', 'hardlink', 'symlink', 'rename', 'copy')
+_FICLONE = 0x40049409  # Linux ioctl that clones a file's extents (btrfs, xfs, ...)
+
+def _reflink(src, dst):
+    """Copy-on-write clone of src to dst, raising OSError where unsupported"""
+    import fcntl
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+def _place_file(src, dst, mode):
+    """Materialize src at dst with the requested mode, falling back to a copy. Returns the method used"""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    attempts = {'auto': ('hardlink', 'reflink'), 'copy': ()}.get(mode, (mode,))
+    for method in attempts:
+        try:
+            if method == 'reflink':
+                _reflink(src, dst)
+            elif method == 'hardlink':
+                os.link(src, dst)
+            elif method == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            elif method == 'rename':
+                os.replace(src, dst)
+            return method
+        except (OSError, ImportError):
+            continue
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def materialize_files(file_list, source_dir, target_dir, mode='auto', max_workers=8):
+    """Place files into target_dir with links where possible, copying on a thread pool otherwise.
+
+    Returns a stats dict with the file count, bytes moved, elapsed seconds and
+    how many files each method handled.
+    """
+    if mode not in MATERIALIZE_MODES:
+        raise ValueError(f"Unknown materialize mode '{mode}', expected one of {MATERIALIZE_MODES}")
+    os.makedirs(target_dir, exist_ok=True)
+    start = time.monotonic()
+    sources = [os.path.join(source_dir, file_name) for file_name in file_list]
+    # Stat before placing, a rename leaves nothing behind at the source
+    total_bytes = sum(os.path.getsize(src) for src in sources)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        methods = list(executor.map(lambda src: _place_file(src, os.path.join(target_dir, os.path.basename(src)), mode),
+                                    sources))
+    stats = {'files': len(sources), 'bytes': total_bytes, 'seconds': time.monotonic() - start}
+    for method in methods:
+        stats[method] = stats.get(method, 0) + 1
+    return stats
+
+def is_current(src, dst):
+    """True if dst already holds src: the same inode, or a copy with matching size and mtime"""
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    src_stat = os.stat(src)
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True
+    return src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+def move_files(file_list, source_dir, target_dir, mode='copy'):
     """Move files to their respective directories"""
     try:
-        os.makedirs(target_dir, exist_ok=True)
-        for file_name in file_list:
-            shutil.copy(os.path.join(source_dir, file_name), os.path.join(target_dir, file_name))  # Using copy for testing
+        return materialize_files(file_list, source_dir, target_dir, mode=mode)
     except Exception as e:
         logger.error(f"Error in move_files: {e}", exc_info=True)
         raise
@@ -141,66 +352,212 @@ def move_files(file_list, source_dir, target_dir):
 def _apply_aug():
     pass
 
-def download_and_unzip(LS_ID, Type='YOLO'):
-    def download_single(ls_id, target_folder):
+def _ls_base_url():
+    """Base URL of the Label Studio instance configured in the environment"""
+    return f"http://{os.getenv('HOST')}:{os.getenv('PORT')}"
+
+def make_session(pool_size=8):
+    """Shared requests.Session with keep-alive connections and the Label Studio token"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Authorization'] = f"Token {os.getenv('LS_TOKEN')}"
+    return session
+
+# A private generator so split_dataset's random.seed doesn't synchronise the jitter
+_jitter = random.Random()
+
+def _backoff_delay(attempt, base=1.0, cap=30.0):
+    """Exponential backoff with full jitter"""
+    return _jitter.uniform(0, min(cap, base * 2 ** attempt))
+
+def stream_download(url, spool_path, session, chunk_size=CHUNK_SIZE, timeout=None):
+    """Stream a response body into spool_path, resuming a partial spool with HTTP Range.
+
+    Returns a (total_bytes, fetched_bytes) tuple and raises on HTTP or transfer errors.
+    """
+    offset = os.path.getsize(spool_path) if os.path.exists(spool_path) else 0
+    headers = {}
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+        logger.info(f"Resuming download of {url} from byte {offset}")
+    fetched = 0
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        logger.info(f"Response status code: {response.status_code}")
+        if response.status_code == 416 and offset:
+            # The spool already holds the whole body
+            return offset, fetched
+        response.raise_for_status()
+        if response.status_code == 200 and offset:
+            logger.info("Server ignored the Range header, restarting download")
+            offset = 0
+        expected = response.headers.get('Content-Length')
+        expected = offset + int(expected) if expected is not None else None
+        with open(spool_path, 'ab' if offset else 'wb') as spool:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                spool.write(chunk)
+                fetched += len(chunk)
+    total = os.path.getsize(spool_path)
+    if expected is not None and total < expected:
+        raise IOError(f"Incomplete download: {total}/{expected} bytes")
+    return total, fetched
+
+def replace_folder(staging_folder, target_folder):
+    """Swap a freshly written folder in for target_folder, so nothing from the previous contents survives"""
+    old_folder = f"{target_folder}.old"
+    shutil.rmtree(old_folder, ignore_errors=True)
+    if os.path.exists(target_folder):
+        os.rename(target_folder, old_folder)
+    os.rename(staging_folder, target_folder)
+    shutil.rmtree(old_folder, ignore_errors=True)
+
+def extract_zip(zip_path, target_folder):
+    """Extract archive members one at a time so memory stays bounded by a single chunk"""
+    os.makedirs(target_folder, exist_ok=True)
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = zip_ref.infolist()
+        for member in members:
+            path = zip_ref.extract(member, target_folder)
+            if not member.is_dir():
+                # Keep the archive's timestamps, so is_current knows unchanged files after a re-export
+                mtime = time.mktime(member.date_time + (0, 0, -1))
+                os.utime(path, (mtime, mtime))
+    return len(members)
+
+def download_single(ls_id, target_folder, session, Type='YOLO', extract=True):
+    """Download and extract one Label Studio export, returning the archive size in bytes
+
+    With extract=False the archive is kept as <target_folder>.zip instead.
+    """
+    url = f"{_ls_base_url()}/api/projects/{ls_id}/export?exportType={Type}"
+    spool_path = f"{target_folder}.zip.part"
+    logger.info(f'Data download started for LS_ID {ls_id}.......')
+    start = time.monotonic()
+    total, fetched = stream_download(url, spool_path, session)
+    elapsed = max(time.monotonic() - start, 1e-6)
+    logger.info(f"Downloaded {total / 1e6:.1f} MB for LS_ID {ls_id} at {fetched / elapsed / 1e6:.2f} MB/s "
+                f"(peak RSS {instrument.peak_rss_mb():.0f} MB)")
+    if not extract:
         try:
-            unzipped_folder_name = target_folder
-            _HOST = os.getenv("HOST")
-            _PORT = os.getenv("PORT")
-            url = f"http://{_HOST}:{_PORT}/api/projects/{ls_id}/export?exportType={Type}"
-            token = os.getenv("LS_TOKEN")
-            headers = {"Authorization": f"Token {token}"}
-            logger.info(f'Data download started for LS_ID {ls_id}.......')
-            response = requests.get(url, headers=headers, stream=True)
-            logger.info(f"Response status code: {response.status_code}")
-            if response.status_code == 200:
-                with zipfile.ZipFile(BytesIO(response.raw.read()), 'r') as zip_ref:
-                    os.makedirs(unzipped_folder_name, exist_ok=True)
-                    zip_ref.extractall(unzipped_folder_name)
-                logger.info(f'Download ✅ for LS_ID {ls_id}')
-            else:
-                logger.error(f"Downloading failed from label studio for LS_ID {ls_id}", exc_info=True)
-                # logger.error(f"Error in downloading data for LS_ID {ls_id}")
-                return False
+            zipfile.ZipFile(spool_path).close()  # Fail on a corrupt archive like extraction would
+        except zipfile.BadZipFile:
+            os.remove(spool_path)
+            raise
+        os.replace(spool_path, f"{target_folder}.zip")
+        logger.info(f'Download ✅ for LS_ID {ls_id} (kept as {target_folder}.zip)')
+        return total
+    # Extract next to the target and swap it in: data/ outlives a split that keeps its source
+    # (manifest layout, symlinks), and tasks deleted upstream must not linger in it
+    staging_folder = f"{target_folder}.new"
+    shutil.rmtree(staging_folder, ignore_errors=True)
+    try:
+        with instrument.stage('extract', ls_id=ls_id):
+            members = extract_zip(spool_path, staging_folder)
+            instrument.count(files=members, bytes=total)
+    except zipfile.BadZipFile:
+        # A corrupt spool can't be resumed, start over on the next attempt
+        os.remove(spool_path)
+        shutil.rmtree(staging_folder, ignore_errors=True)
+        raise
+    replace_folder(staging_folder, target_folder)
+    os.remove(spool_path)
+    logger.info(f'Download ✅ for LS_ID {ls_id} ({members} files extracted, peak RSS {instrument.peak_rss_mb():.0f} MB)')
+    return total
+
+def download_project(ls_id, target_folder, session, Type='YOLO', attempts=4, extract=True):
+    """Download one project with exponential backoff, returning a report dict"""
+    report = {'ls_id': ls_id, 'ok': False, 'attempts': 0, 'bytes': 0, 'seconds': 0.0, 'error': None}
+    start = time.monotonic()
+    for attempt in range(attempts):
+        report['attempts'] = attempt + 1
+        try:
+            report['bytes'] = download_single(ls_id, target_folder, session, Type, extract)
+            report['ok'] = True
+            break
         except Exception as e:
-            logger.error(f"Download and unzip failed for LS_ID {ls_id}: {e}", exc_info=True)
-            return False
-        return True
+            report['error'] = str(e)
+            logger.warning(f"Download attempt {attempt + 1}/{attempts} failed for LS_ID {ls_id}: {e}")
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if status in (400, 401, 403, 404):
+                # Retrying won't fix a bad token or a missing project
+                break
+            if attempt + 1 < attempts:
+                time.sleep(_backoff_delay(attempt))
+    report['seconds'] = time.monotonic() - start
+    return report
 
+def download_projects(ls_ids, temp_folder='_temp', Type='YOLO', max_workers=4, attempts=4):
+    """Download several projects concurrently over one pooled session"""
+    os.makedirs(temp_folder, exist_ok=True)
+    with make_session(pool_size=max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(download_project, ls_id, os.path.join(temp_folder, str(ls_id)), session, Type, attempts)
+                   for ls_id in ls_ids]
+        reports = [future.result() for future in futures]
+
+    for report in reports:
+        status = '✅' if report['ok'] else f"❌ ({report['error']})"
+        logger.info(f"LS_ID {report['ls_id']}: {status} {report['bytes'] / 1e6:.1f} MB in {report['seconds']:.1f}s "
+                    f"after {report['attempts']} attempt(s)")
+    return reports
+
+def project_summary(ls_id, session):
+    """The parts of a project that change whenever its tasks, annotations or labels do
+
+    The project counters catch added and deleted tasks and annotations, but editing
+    existing boxes changes none of them, so the most recently updated task and the
+    versions of its annotations are included as well.
+    """
+    response = session.get(f"{_ls_base_url()}/api/projects/{ls_id}/", timeout=30)
+    response.raise_for_status()
+    project = response.json()
+    keys = ('id', 'task_number', 'total_annotations_number', 'num_tasks_with_annotations',
+            'total_predictions_number', 'label_config')
+    summary = {key: project.get(key) for key in keys}
+    response = session.get(f"{_ls_base_url()}/api/tasks", timeout=30,
+                           params={'project': ls_id, 'fields': 'all', 'ordering': '-updated_at', 'page': 1,
+                                   'page_size': 1})
+    response.raise_for_status()
+    payload = response.json()
+    tasks = payload.get('tasks', []) if isinstance(payload, dict) else payload
+    latest = tasks[0] if tasks else {}
+    summary['latest_task'] = {'id': latest.get('id'), 'updated_at': latest.get('updated_at'),
+                              'annotations': [[a.get('id'), a.get('updated_at')] for a in latest.get('annotations', [])]}
+    return summary
+
+def merge_projects(max_per_class=None):
+    """Merge the projects downloaded into _temp into data/"""
+    success, message = check_classes()
+    if not success:
+        logger.error(message)
+        return False
+    _take_samples(max_per_class)
+    return True
+
+def download_and_unzip(LS_ID, Type='YOLO', max_workers=4, attempts=4, max_per_class=None, extract=True, merge=True):
+    """Download one project into data/, or several into _temp/ and merge them into data/ unless merge=False"""
     try:
-        failed_ls_ids = []
         if isinstance(LS_ID, list) and len(LS_ID) > 1: # Download multiple LS_IDs
-            temp_folder = '_temp'
-            os.makedirs(temp_folder, exist_ok=True)
-            for ls_id in LS_ID:
-                if not download_single(ls_id, os.path.join(temp_folder, str(ls_id))):
-                    failed_ls_ids.append(ls_id)
-
-            # Retry for failed LS_IDs up to 3 times
-            for attempt in range(1, 4):
-                if not failed_ls_ids:
-                    break
-                logger.info(f"Retry attempt {attempt} for failed LS_IDs: {failed_ls_ids}")
-                new_failed_ls_ids = []
-                for ls_id in failed_ls_ids:
-                    if not download_single(ls_id, os.path.join(temp_folder, str(ls_id))):
-                        new_failed_ls_ids.append(ls_id)
-                failed_ls_ids = new_failed_ls_ids
+            if not extract:
+                raise ValueError("Merging several projects needs them extracted, extract=False takes a single LS_ID.")
+            reports = download_projects(LS_ID, '_temp', Type, max_workers=max_workers, attempts=attempts)
+            instrument.count(files=sum(report['ok'] for report in reports), bytes=sum(report['bytes'] for report in reports))
+            failed_ls_ids = [report['ls_id'] for report in reports if not report['ok']]
             if failed_ls_ids:
-                # logger.error(f"Failed to download after 3 attempts for LS_IDs: {failed_ls_ids}")
-                logger.error(f"Failed to download after 3 attempts for LS_IDs: {failed_ls_ids}")
-            if len(LS_ID) > 1:
-                success, message = check_classes()
-                if not success:
-                    logger.error(message)
-                    return
-                _take_samples()
+                logger.error(f"Failed to download after {attempts} attempts for LS_IDs: {failed_ls_ids}")
+            if not merge:
+                # The caller merges later; report the failure so the download isn't taken as complete
+                return not failed_ls_ids
+            if not merge_projects(max_per_class):
+                return
             return True
         else:
             if isinstance(LS_ID, list):
                 LS_ID = LS_ID[0]
-            download_single(LS_ID, 'data')
-            return True
+            with make_session(pool_size=1) as session:
+                report = download_project(LS_ID, 'data', session, Type, attempts, extract)
+            instrument.count(files=int(report['ok']), bytes=report['bytes'])
+            return report['ok']
     except Exception as e:
         logger.error(f"Error in download_and_unzip: {e}", exc_info=True)
         raise
@@ -0,0 +1,218 @@
+import io
+import os
+import math
+import mmap
+import struct
+import zipfile
+import zlib
+import numpy as np
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from logger import logger
+from imagecache import buffer_image, _EXIF_ORIENTATION
+from labelindex import _parse_label_text
+from utils import split_dataset, IMAGE_EXTENSIONS
+
+_LOCAL_HEADER = struct.Struct('<4s5H3I2H')
+# Enough of a member to hold its image header and EXIF block in nearly every case
+_HEAD_BYTES = 1 << 16
+
+
+class ZipArchive:
+    """Random access to the members of a zip file through mmap, without extracting it.
+
+    The central directory is read once; stored members are returned as zero-copy
+    memoryviews of the mapping and deflated members are inflated on the fly.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.members = {}
+        with zipfile.ZipFile(path, 'r') as zip_ref:
+            infos = [info for info in zip_ref.infolist() if not info.is_dir()]
+        with open(path, 'rb') as f:
+            for info in infos:
+                f.seek(info.header_offset)
+                header = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+                name_length, extra_length = header[-2:]
+                data_offset = info.header_offset + _LOCAL_HEADER.size + name_length + extra_length
+                self.members[info.filename] = (data_offset, info.compress_size, info.compress_type)
+        self._mmap = None
+
+    def __getstate__(self):
+        # Dataloader workers map the file themselves
+        state = self.__dict__.copy()
+        state['_mmap'] = None
+        return state
+
+    @property
+    def buffer(self):
+        if self._mmap is None:
+            with open(self.path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def names(self, prefix=''):
+        return sorted(name for name in self.members if name.startswith(prefix))
+
+    def read(self, name):
+        offset, size, compress_type = self.members[name]
+        data = memoryview(self.buffer)[offset:offset + size]
+        if compress_type == zipfile.ZIP_STORED:
+            return data
+        if compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -15)
+        raise ValueError(f"Unsupported compression {compress_type} for {name}")
+
+    def read_head(self, name, size=_HEAD_BYTES):
+        """The first size bytes of a member, inflating no more than that"""
+        offset, compressed_size, compress_type = self.members[name]
+        data = memoryview(self.buffer)[offset:offset + compressed_size]
+        if compress_type == zipfile.ZIP_STORED:
+            return data[:size]
+        if compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompressobj(-15).decompress(data, size)
+        raise ValueError(f"Unsupported compression {compress_type} for {name}")
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def read_image(self, name):
+        """Decode a member into a BGR array like cv2.imread"""
+        import cv2
+        return cv2.imdecode(np.frombuffer(self.read(name), dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def image_shape(self, name):
+        """(height, width) as read_image decodes it, read from the image header"""
+        try:
+            return _decoded_shape(self.read_head(name))
+        except OSError:
+            # The header reaches past the first bytes, e.g. behind a large embedded thumbnail
+            return _decoded_shape(self.read(name))
+
+    def read_labels(self, name):
+        """Rows of (class, x, y, w, h) of a label member, empty if the member is missing"""
+        if name not in self.members:
+            return _parse_label_text('')
+        return _parse_label_text(bytes(self.read(name)).decode('utf-8'))
+
+    def class_names(self):
+        if 'classes.txt' not in self.members:
+            return []
+        return [line.strip() for line in bytes(self.read('classes.txt')).decode('utf-8').splitlines() if line.strip()]
+
+
+def _decoded_shape(data):
+    """(height, width) of an encoded image once cv2 has applied its EXIF rotation"""
+    with Image.open(io.BytesIO(data)) as image:
+        w, h = image.size
+        # getexif() would load the whole image to look for EXIF after the pixel data
+        exif = Image.Exif()
+        if 'exif' in image.info:
+            exif.load(image.info['exif'])
+    if exif.get(_EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+        w, h = h, w
+    return h, w
+
+
+def label_member(image_member):
+    """labels/<stem>.txt for images/<stem>.<ext>, the layout of Label Studio's YOLO export"""
+    stem = os.path.splitext(os.path.basename(image_member))[0]
+    return f"{os.path.dirname(image_member).replace('images', 'labels', 1)}/{stem}.txt".lstrip('/')
+
+
+def write_split_lists(zip_path, output_dir='datasets', split_ratios=(0.95, 0.025, 0.025), seed=46, strategy='hash'):
+    """Write datasets/{train,valid,test}.txt listing archive members, without extracting anything"""
+    archive = ZipArchive(zip_path)
+    image_files = [name for name in archive.names('images/') if name.lower().endswith(IMAGE_EXTENSIONS)]
+    label_files = [label_member(name) for name in image_files]
+    histogram = None
+    if strategy == 'stratified':
+        rows = [archive.read_labels(name) for name in label_files]
+        num_classes = max([int(r[:, 0].max()) + 1 for r in rows if len(r)] + [1])
+        histogram = np.stack([np.bincount(r[:, 0].astype(np.int64), minlength=num_classes) for r in rows])
+    train_images, _, valid_images, _, test_images, _ = split_dataset(
+        image_files, label_files, split_ratios, seed=seed, strategy=strategy, histogram=histogram)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for split, images in (('train', train_images), ('valid', valid_images), ('test', test_images)):
+        with open(os.path.join(output_dir, f'{split}.txt'), 'w') as f:
+            f.writelines(f"{name}\n" for name in images)
+    logger.info(f"Wrote split lists for {len(image_files)} archive members to {output_dir}")
+    return archive.class_names()
+
+
+def zip_trainer(zip_path):
+    """A DetectionTrainer that reads images and labels straight out of the export archive at zip_path"""
+    from copy import copy
+    import cv2
+    from ultralytics.data import YOLODataset
+    from ultralytics.models.yolo.detect import DetectionTrainer, DetectionValidator
+    from ultralytics.utils import colorstr, torch_utils
+
+    # de_parallel was renamed unwrap_model in newer ultralytics releases
+    unwrap_model = getattr(torch_utils, 'unwrap_model', None) or torch_utils.de_parallel
+
+    archive = ZipArchive(zip_path)
+
+    class ZipYOLODataset(YOLODataset):
+        def get_img_files(self, img_path):
+            with open(img_path, 'r') as f:
+                names = [line.strip() for line in f if line.strip()]
+            missing = [name for name in names if name not in archive]
+            if missing:
+                raise FileNotFoundError(f"{len(missing)} listed images are not in {zip_path}, e.g. {missing[0]}")
+            return names
+
+        def get_labels(self):
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                shapes = list(executor.map(archive.image_shape, self.im_files))
+            labels = []
+            for name, shape in zip(self.im_files, shapes):
+                rows = archive.read_labels(label_member(name))
+                labels.append(dict(im_file=name, shape=shape, cls=rows[:, 0:1], bboxes=rows[:, 1:], segments=[],
+                                   keypoints=None, normalized=True, bbox_format='xywh'))
+            return labels
+
+        def load_image(self, i, rect_mode=True, resize_short=False):
+            im = archive.read_image(self.im_files[i])
+            if im is None:
+                raise FileNotFoundError(f"Could not decode {self.im_files[i]} from {zip_path}")
+            h0, w0 = im.shape[:2]
+            if rect_mode:
+                r = self.imgsz / (min(h0, w0) if resize_short else max(h0, w0))
+                if r != 1:
+                    if resize_short:
+                        w, h = (math.ceil(w0 * r), self.imgsz) if h0 < w0 else (self.imgsz, math.ceil(h0 * r))
+                    else:
+                        w, h = (min(math.ceil(w0 * r), self.imgsz), min(math.ceil(h0 * r), self.imgsz))
+                    im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
+            elif not (h0 == w0 == self.imgsz):
+                im = cv2.resize(im, (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR)
+            # Mosaic draws its extra images from the buffer, as it does for the stock dataset
+            buffer_image(self, i, im, (h0, w0), im.shape[:2])
+            return im, (h0, w0), im.shape[:2]
+
+    def build_dataset(cfg, img_path, batch, data, mode, rect, stride):
+        # Mirrors ultralytics.data.build_yolo_dataset with the archive-backed dataset
+        return ZipYOLODataset(img_path=img_path, imgsz=cfg.imgsz, batch_size=batch, augment=mode == 'train', hyp=cfg,
+                              rect=cfg.rect or rect, cache=None, single_cls=cfg.single_cls or False,
+                              stride=int(stride), pad=0.0 if mode == 'train' else 0.5, prefix=colorstr(f"{mode}: "),
+                              task=cfg.task, classes=cfg.classes, data=data,
+                              fraction=cfg.fraction if mode == 'train' else 1.0)
+
+    class ZipDetectionValidator(DetectionValidator):
+        def build_dataset(self, img_path, mode='val', batch=None):
+            return build_dataset(self.args, img_path, batch, self.data, mode, False, self.stride)
+
+    class ZipDetectionTrainer(DetectionTrainer):
+        def build_dataset(self, img_path, mode='train', batch=None):
+            gs = max(int(unwrap_model(self.model).stride.max() if self.model else 0), 32)
+            return build_dataset(self.args, img_path, batch, self.data, mode, mode == 'val', gs)
+
+        def get_validator(self):
+            self.loss_names = 'box_loss', 'cls_loss', 'dfl_loss'
+            return ZipDetectionValidator(self.test_loader, save_dir=self.save_dir, args=copy(self.args),
+                                         _callbacks=self.callbacks)
+
+    return ZipDetectionTrainer